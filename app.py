@@ -3,40 +3,334 @@ import logging
 import shlex
 import json
 import pymongo
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlencode
 from slack import WebClient
-from quart import abort, Quart, jsonify, request
-import requests
+from slack.errors import SlackApiError
+from quart import abort, Quart, jsonify, request, g, Response, redirect
+import prometheus_client
+from prometheus_client import multiprocess
+import aiohttp
 import bson
 import re
 import asyncio
+import functools
+import time
+import bisect
+import heapq
+import math
+import datetime
+import threading
+import secrets
+import collections
+import hmac
+import hashlib
+import csv
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+try:
+    import numpy as np
+except ImportError:
+    # suggestions fall back to the pure python bitset matcher
+    np = None
 
-# TODO: add rate restaurant feature (1 hour later, rating/price/duration)
-# TODO: use Google Maps to geocode & get device position in order to take walking time into account
 # TODO: major refactor (modules)
 # TODO: add a feature to opt-out ("I don't care")
-# TODO: if a user doesn't answer after a time limit, it should be opted out
 # TODO: show partial results (not good for 1-2 persons)
 
 # globals
 app = Quart(__name__)
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 logger = logging.getLogger("lunchbot")
 mongodb_uri = os.environ.get("MONGODB_URI")
+mongodb_pool_size = int(os.environ.get("MONGODB_POOL_SIZE", 10))
 try:
-    conn = pymongo.MongoClient(mongodb_uri)
+    conn = pymongo.MongoClient(mongodb_uri, maxPoolSize=mongodb_pool_size)
     logger.info("MongoDB connection successful.")
 except pymongo.errors.ConnectionFailure as e:
     logger.info(f"Could not connect to MongoDB: {e}")
 
 db = conn[urlparse(mongodb_uri).path[1:]]
-slack_client = WebClient(os.environ.get('SLACK_ACCESS_TOKEN'), run_async=True)
-bot_client = WebClient(os.environ.get('SLACK_BOT_TOKEN'), run_async=True)
+# pymongo is blocking, so db calls run on a thread pool sized to the connection pool
+db_executor = ThreadPoolExecutor(max_workers=mongodb_pool_size, thread_name_prefix="lunchbot-db")
+slack_api_url = os.environ.get("SLACK_API_URL", "https://www.slack.com/api/")
+# every workspace installing the app through oauth gets its own tokens, kept in the installations collection
+slack_client_id = os.environ.get("SLACK_CLIENT_ID")
+slack_client_secret = os.environ.get("SLACK_CLIENT_SECRET")
+slack_bot_scopes = os.environ.get("SLACK_BOT_SCOPES", "commands,chat:write,im:write,users:read")
+oauth_state_max_age = int(os.environ.get("OAUTH_STATE_MAX_AGE", 10 * 60))
+# single-workspace deployments can keep their tokens in the environment, documents from before
+# multi-workspace support are assigned to this team on startup
+slack_team_id = os.environ.get("SLACK_TEAM_ID")
+legacy_installation = {
+    "_id": slack_team_id,
+    "access_token": os.environ.get("SLACK_ACCESS_TOKEN"),
+    "bot_token": os.environ.get("SLACK_BOT_TOKEN")
+} if slack_team_id is not None and os.environ.get("SLACK_BOT_TOKEN") else None
+if slack_team_id is None and (os.environ.get("SLACK_BOT_TOKEN") or os.environ.get("SLACK_ACCESS_TOKEN")):
+    # the tokens would be silently ignored and the workspace would stop working
+    raise ValueError("SLACK_BOT_TOKEN and SLACK_ACCESS_TOKEN need SLACK_TEAM_ID to be set!")
+# installations keyed by team id, reloaded after the ttl and evicted right away on uninstall,
+# missing ones are not cached so a workspace can be used right after it's installed
+installation_cache = {}
+installation_cache_ttl = int(os.environ.get("INSTALLATION_CACHE_TTL", 5 * 60))
+# web clients keyed by token, the least recently used ones are dropped
+slack_clients = collections.OrderedDict()
+slack_client_pool_size = int(os.environ.get("SLACK_CLIENT_POOL_SIZE", 100))
+# every request has to be signed by slack, see https://api.slack.com/authentication/verifying-requests-from-slack
+slack_signing_secret = os.environ.get("SLACK_SIGNING_SECRET", "").encode()
+slack_request_max_age = int(os.environ.get("SLACK_REQUEST_MAX_AGE", 5 * 60))
+# signatures seen within the max age, a repeated one is a replay
+slack_request_signatures = collections.OrderedDict()
+if not slack_signing_secret:
+    logger.error("SLACK_SIGNING_SECRET is not set, every request will be rejected.")
+# shared keep-alive pool for response_url posts, created when the app starts serving
+http_session = None
+response_url_max_connections = int(os.environ.get("RESPONSE_URL_MAX_CONNECTIONS", 20))
+response_url_timeout = float(os.environ.get("RESPONSE_URL_TIMEOUT", 5))
+response_url_retries = int(os.environ.get("RESPONSE_URL_RETRIES", 3))
+response_url_backoff = float(os.environ.get("RESPONSE_URL_BACKOFF", 0.5))
+# members of each workspace keyed by user id, fully reloaded after the ttl and patched from slack events in between
+user_directories = {}
+user_directory_ttl = int(os.environ.get("USER_DIRECTORY_TTL", 3600))
+user_directory_locks = collections.defaultdict(asyncio.Lock)
+# process-local restaurant catalog of each team, invalidated on writes and by the change stream (or polled without it)
+restaurant_catalogs = {}
+# every invalidation bumps the generation of the team, a rebuild that read the restaurants before it isn't kept,
+# and concurrent misses of a team wait for a single rebuild
+restaurant_catalog_generations = collections.defaultdict(int)
+restaurant_catalog_locks = collections.defaultdict(asyncio.Lock)
+restaurant_catalog_poll_interval = int(os.environ.get("RESTAURANT_CATALOG_POLL_INTERVAL", 60))
+restaurant_change_stream_active = False
+# only these fields are loaded from the restaurants collection
+restaurant_fields = [
+    "name", "address", "location", "initial duration", "initial rating", "initial price", "tags", "last visited",
+    "feedback"
+]
+# fields shown under the name when listing restaurants
+restaurant_listed_fields = ["address", "initial duration", "initial rating", "initial price", "tags"]
+# 2 blocks per restaurant, slack allows 50 blocks per message
+restaurants_page_size = int(os.environ.get("RESTAURANTS_PAGE_SIZE", 10))
+# restaurants waiting for confirmation, keyed by the token in the confirm buttons;
+# the lru cache serves the common case, the ttl-indexed collection works across workers
+pending_restaurant_ttl = int(os.environ.get("PENDING_RESTAURANT_TTL", 60 * 60))
+pending_restaurant_cache_size = int(os.environ.get("PENDING_RESTAURANT_CACHE_SIZE", 256))
+pending_restaurant_cache = collections.OrderedDict()
+# columns of bulk imports and exports, restaurants are deduplicated by name
+restaurant_import_fields = ["name", "address", "initial duration", "initial rating", "initial price", "tags"]
+# optional columns, restaurants without them are looked up in the geocoding table
+restaurant_import_location_fields = ["latitude", "longitude"]
+restaurant_import_batch_size = int(os.environ.get("RESTAURANT_IMPORT_BATCH_SIZE", 500))
+# offices as {"name": {"location": [latitude, longitude], "users": [user ids]}},
+# users not listed in any of them belong to the first one
+offices = json.loads(os.environ.get("OFFICES", "{}"))
+user_offices = {user_id: name for name, office in offices.items() for user_id in office.get("users", [])}
+default_office = next(iter(offices), None)
+# walking speed in km/h, distances are multiplied by the detour factor since streets are not straight lines
+walking_speed = float(os.environ.get("WALKING_SPEED", 4.5))
+walking_detour_factor = float(os.environ.get("WALKING_DETOUR_FACTOR", 1.3))
+# offline geocoding table, a csv file with the columns address, latitude, longitude,
+# loaded on startup so requests never wait for the file
+geocoding_table_path = os.environ.get("GEOCODING_TABLE")
+geocoding_table = {}
+# weights of the suggestion score and how many of the best restaurants are suggested
+suggestion_weights = {
+    "rating": float(os.environ.get("SUGGESTION_WEIGHT_RATING", 1.0)),
+    "price": float(os.environ.get("SUGGESTION_WEIGHT_PRICE", 0.5)),
+    "duration": float(os.environ.get("SUGGESTION_WEIGHT_DURATION", 0.5)),
+    "recency": float(os.environ.get("SUGGESTION_WEIGHT_RECENCY", 1.0))
+}
+suggestion_recency_days = float(os.environ.get("SUGGESTION_RECENCY_DAYS", 14))
+suggestion_limit = int(os.environ.get("SUGGESTION_LIMIT", 5))
+# feedback about the restaurant is asked this long after the suggestions are sent
+feedback_delay = int(os.environ.get("FEEDBACK_DELAY", 60 * 60))
+feedback_questions = {
+    "rating": {"label": "Rating", "unit": "", "options": [1, 2, 3, 4, 5]},
+    # like the initial duration it's the time spent eating, walking is added from the restaurant's location
+    "duration": {"label": "Time at the restaurant (without walking)", "unit": " min", "options": [15, 30, 45, 60, 90]},
+    "price": {"label": "Price", "unit": " HUF", "options": [500, 1000, 1500, 2000, 3000]}
+}
+# unfinished sessions (and the preferences stored in them) are cleaned up by a ttl index after this
+session_ttl = int(os.environ.get("SESSION_TTL", 24 * 60 * 60))
+# users who don't answer in time are opted out and the session is finished with the others
+session_timeout = int(os.environ.get("SESSION_TIMEOUT", 30 * 60))
+# deadlines of sessions created by other workers are picked up by rescanning the db this often
+session_deadline_rescan_interval = int(os.environ.get("SESSION_DEADLINE_RESCAN_INTERVAL", 60))
+session_deadlines = []
+session_deadlines_changed = asyncio.Event()
+session_deadline_task = None
+# slack web api rate limit tiers (calls per minute, burst) and the tier of the methods we use,
+# the special tier of chat.postMessage is about a message per second in each channel
+slack_rate_limit_tiers = {
+    2: (20, 5),
+    3: (50, 10),
+    4: (100, 20),
+    "special": (60, 5)
+}
+slack_method_tiers = {
+    "users.list": 2,
+    "im.open": 3,
+    "users.info": 4,
+    "chat.postMessage": "special",
+    "chat.scheduleMessage": 3
+}
+# slack rate limits apply per workspace, so the buckets are keyed by team and tier (and channel for the special tier),
+# least recently used first, a bucket that has refilled is the same as a new one and is dropped
+slack_rate_limit_buckets = collections.OrderedDict()
+slack_api_retries = int(os.environ.get("SLACK_API_RETRIES", 3))
+# DMs go through a bounded queue drained by a fixed number of workers
+dm_concurrency = int(os.environ.get("DM_CONCURRENCY", 5))
+dm_queue_size = int(os.environ.get("DM_QUEUE_SIZE", 1000))
+dm_queue = None
+dm_workers = []
+# dm channel ids keyed by team and user id
+dm_channels = {}
+# metrics exposed on /metrics, with several gunicorn workers PROMETHEUS_MULTIPROC_DIR has to be set
+request_latency = prometheus_client.Histogram(
+    "lunchbot_request_seconds", "Latency of the web server routes.", ["route"]
+)
+action_latency = prometheus_client.Histogram(
+    "lunchbot_action_seconds", "Latency of handling an interaction, including answering it.", ["action"]
+)
+db_latency = prometheus_client.Histogram(
+    "lunchbot_db_seconds", "Latency of the db functions, including waiting for the executor.", ["function"]
+)
+slack_api_calls = prometheus_client.Counter(
+    "lunchbot_slack_api_calls_total", "Slack Web API calls.", ["method"]
+)
+slack_api_rate_limited = prometheus_client.Counter(
+    "lunchbot_slack_api_rate_limited_total", "Slack Web API calls answered with 429.", ["method"]
+)
+dm_deliveries = prometheus_client.Counter(
+    "lunchbot_dms_total", "DMs by delivery status.", ["status"]
+)
+errors = prometheus_client.Counter(
+    "lunchbot_errors_total", "Errors logged and swallowed while handling requests.", ["source"]
+)
+# the action id of buttons often ends in a value, metrics are labeled by these prefixes
+action_metric_labels = [
+    "confirm-add-restaurant", "remove-restaurant", "list-restaurants-page", "answer-time-limit",
+    "answer-price-limit", "answer-tag-exclude", "finish-tag-exclude", "feedback-restaurant", "feedback"
+]
+# strong references to fire-and-forget tasks, otherwise they can be garbage collected mid-flight
+background_tasks = set()
 
 
 """ WEB SERVER ROUTES """
 
 
+@app.before_serving
+async def open_http_session():
+    global http_session
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=response_url_max_connections),
+        timeout=aiohttp.ClientTimeout(total=response_url_timeout)
+    )
+
+
+@app.before_serving
+async def prepare_database():
+    # the old documents have to be migrated before the team_id indexes are built on them
+    await migrate_legacy_documents(slack_team_id)
+    await ensure_indexes()
+    # deployments from before the tag vocabulary existed only have tags on the restaurants
+    if slack_team_id is not None and await is_tag_vocabulary_empty(slack_team_id):
+        await rebuild_tag_vocabulary(slack_team_id)
+
+
+@app.before_serving
+async def prepare_geocoding_table():
+    # reading the csv blocks, so it's done on a thread before the first request
+    await asyncio.get_running_loop().run_in_executor(None, load_geocoding_table)
+
+
+@app.before_serving
+async def start_watching_restaurants():
+    threading.Thread(
+        target=watch_restaurant_changes,
+        args=(asyncio.get_running_loop(),),
+        name="lunchbot-restaurant-watch",
+        daemon=True
+    ).start()
+
+
+@app.before_serving
+async def start_dm_workers():
+    global dm_queue
+    dm_queue = asyncio.Queue(maxsize=dm_queue_size)
+    for _ in range(dm_concurrency):
+        dm_workers.append(asyncio.create_task(process_dm_queue()))
+
+
+@app.before_serving
+async def start_session_deadlines():
+    global session_deadline_task
+    session_deadline_task = asyncio.create_task(run_session_deadlines())
+
+
+@app.after_serving
+async def close_http_session():
+    await http_session.close()
+
+
+@app.after_serving
+async def stop_dm_workers():
+    for dm_worker in dm_workers:
+        dm_worker.cancel()
+
+
+@app.after_serving
+async def stop_session_deadlines():
+    session_deadline_task.cancel()
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+
+@app.after_request
+async def observe_request_latency(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unknown"
+    request_latency.labels(route).observe(time.perf_counter() - g.request_started_at)
+    return response
+
+
+@app.before_request
+async def verify_slack_request():
+    # these are not called by slack, the oauth callback is checked by its state instead
+    if request.path in ("/metrics", "/install", "/oauth"):
+        return
+    # cheap checks first, so forged or replayed requests are dropped before reading the body
+    timestamp = request.headers.get("X-Slack-Request-Timestamp", "")
+    signature = request.headers.get("X-Slack-Signature", "")
+    if not slack_signing_secret or not timestamp.isdigit() or \
+            abs(time.time() - int(timestamp)) > slack_request_max_age:
+        abort(401)
+    if signature in slack_request_signatures:
+        abort(401)
+
+    body = await request.get_data()
+    expected_signature = "v0=" + hmac.new(
+        slack_signing_secret,
+        b"v0:" + timestamp.encode() + b":" + body,
+        hashlib.sha256
+    ).hexdigest()
+    if not hmac.compare_digest(expected_signature, signature):
+        abort(401)
+
+    now = time.monotonic()
+    slack_request_signatures[signature] = now + slack_request_max_age
+    # signatures older than the max age can't be replayed anymore, the timestamp check rejects them
+    while next(iter(slack_request_signatures.values())) <= now:
+        slack_request_signatures.popitem(last=False)
+
+
 @app.route("/command/lunchbot-add-restaurant", methods=["POST"])
 async def handle_add_restaurant():
     try:
@@ -49,6 +343,8 @@ async def handle_add_restaurant():
         elif len(parameters) < 6:
             response = get_response_for_add_restaurant_few_arguments()
         else:
+            # coordinates can be given as an @<latitude>,<longitude> parameter among the tags
+            locations = [parameter[1:] for parameter in parameters[5:] if parameter.startswith("@")]
             try:
                 confirmation_answer = {
                     "name": parameters[0],
@@ -56,27 +352,73 @@ async def handle_add_restaurant():
                     "initial duration": int(parameters[2]),
                     "initial rating": int(parameters[3]),
                     "initial price": int(parameters[4]),
-                    "tags": parameters[5:]
+                    "tags": [parameter for parameter in parameters[5:] if not parameter.startswith("@")]
                 }
+                location = parse_location(locations[0]) if len(locations) > 0 else geocode(parameters[1])
             except ValueError:
                 response = {
                     "response_type": "ephermal",
-                    "text": "Duration, rating and price should be numbers, see `/lunchbot-add-restaurant help` for usage."
+                    "text": "Duration, rating, price and coordinates should be numbers, "
+                            "see `/lunchbot-add-restaurant help` for usage."
                 }
             else:
-                response = get_response_for_add_restaurant_confirm(confirmation_answer.items())
-                db["temp"].insert_one(confirmation_answer)
+                if location is not None:
+                    confirmation_answer["location"] = location
+                token = secrets.token_urlsafe(16)
+                response = get_response_for_add_restaurant_confirm(confirmation_answer.items(), token)
+                await store_pending_restaurant(request_values["team_id"], token, confirmation_answer)
+
+        return jsonify(response)
+    except Exception as e:
+        errors.labels(request.path).inc()
+        logger.error(f"ERROR: {e}")
+        abort(200)
+
+
+@app.route("/command/lunchbot-import-restaurants", methods=["POST"])
+async def handle_import_restaurants():
+    try:
+        request_values = await request.values
+        file_url = request_values["text"].strip()
+
+        if file_url == "" or file_url.startswith("help"):
+            response = get_response_for_import_restaurants_help()
+        elif not file_url.startswith("https://files.slack.com/"):
+            # the bot token is sent along with the download, so it must not leave slack
+            response = {
+                "response_type": "ephermal",
+                "text": "Please, give the URL of a file uploaded to Slack, " +
+                    "see `/lunchbot-import-restaurants help` for usage."
+            }
+        elif get_import_format(file_url) is None:
+            response = {
+                "response_type": "ephermal",
+                "text": "Only `.csv` and `.jsonl` files can be imported."
+            }
+        else:
+            # importing can take longer than slack waits for the answer
+            create_background_task(
+                import_restaurants_from_url(request_values["team_id"], file_url, request_values["response_url"])
+            )
+            response = {
+                "response_type": "ephermal",
+                "text": "Importing restaurants, I'll let you know when it's done."
+            }
 
         return jsonify(response)
     except Exception as e:
+        errors.labels(request.path).inc()
         logger.error(f"ERROR: {e}")
         abort(200)
 
 
 @app.route("/command/lunchbot-list-restaurants", methods=["POST"])
-def handle_list_restaurants():
+async def handle_list_restaurants():
     try:
-        restaurants_markdown = generate_restaurants_markdown()
+        request_values = await request.values
+        restaurants_markdown = generate_restaurants_markdown(
+            await get_restaurant_catalog(request_values["team_id"]), "first"
+        )
         response = {
             "response_type": "ephermal",
             "blocks": restaurants_markdown
@@ -84,6 +426,7 @@ def handle_list_restaurants():
 
         return jsonify(response)
     except Exception as e:
+        errors.labels(request.path).inc()
         logger.error(f"ERROR: {e}")
         abort(200)
 
@@ -98,71 +441,136 @@ async def handle_suggest():
             }
             return jsonify(response)
 
-        # searching for pattern like <@U1234|user>, where we need @U1234
-        user_ids_match = re.finditer("@(\S*)\|", request_values["text"])
-
-        response = await slack_api("users.list")
-        users = response["members"]
-        user_ids = [user["id"] for user in users]
-
-        number_of_mentioned_users = 0
-
-        session_id = ""
-        for user_id_match in user_ids_match:
-            user_id = user_id_match.group(1)
-            if user_id not in user_ids:
-                return jsonify({
-                    "text": f"{user_id} is not valid. Please, make sure all users are real!"
-                })
-            else:
-                # TODO: cancel session if user is already in another session
-                if session_id == "":
-                    session_id = db["sessions"].insert_one({
-                        "started_user_id": request_values["user_id"],
-                        "users": []
-                    }).inserted_id
-                db["sessions"].update_one(
-                    {
-                        "_id": session_id
-                    },
-                    {
-                        "$push": {"users": {"user_id": user_id, "finished": False}}
-                    }
-                )
-                asyncio.create_task(
-                    start_dm(
-                        user_id,
-                        get_blocks_for_asking_time_limit(request_values["user_id"])
-                    )
-                )
-            number_of_mentioned_users += 1
+        # searching for pattern like <@U1234|user>, where we need @U1234 (mentioning someone twice counts once)
+        user_ids = list(dict.fromkeys(re.findall("@(\S*)\|", request_values["text"])))
 
-        if number_of_mentioned_users == 0:
+        if len(user_ids) == 0:
             return jsonify({
                 "text": "I didn't find valid users. Please, make sure all users are real!"
             })
-        else:
+
+        # validate everybody before touching the db or sending any message
+        team_id = request_values["team_id"]
+        validations = await asyncio.gather(*(is_valid_user(team_id, user_id) for user_id in user_ids))
+        invalid_user_ids = [user_id for user_id, is_valid in zip(user_ids, validations) if not is_valid]
+        if len(invalid_user_ids) > 0:
             return jsonify({
-                "text": f"Lunchbot initiated for {number_of_mentioned_users} user(s)."
+                "text": f"{', '.join(invalid_user_ids)} is not valid. Please, make sure all users are real!"
             })
+
+        # TODO: cancel session if user is already in another session
+        session_id, deadline = await create_session(team_id, request_values["user_id"], user_ids)
+        schedule_session_deadline(session_id, deadline)
+        create_background_task(
+            send_dms(team_id, user_ids, get_blocks_for_asking_time_limit(request_values["user_id"]))
+        )
+
+        return jsonify({
+            "text": f"Lunchbot initiated for {len(user_ids)} user(s)."
+        })
     except Exception as e:
+        errors.labels(request.path).inc()
         logger.error(f"ERROR: {e}")
         abort(200)
 
 
+@app.route("/metrics", methods=["GET"])
+async def handle_metrics():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry), content_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+@app.route("/install", methods=["GET"])
+async def handle_install():
+    return redirect("https://slack.com/oauth/v2/authorize?" + urlencode({
+        "client_id": slack_client_id,
+        "scope": slack_bot_scopes,
+        "state": get_oauth_state()
+    }))
+
+
+@app.route("/oauth", methods=["GET"])
+async def handle_oauth():
+    if "error" in request.args:
+        return f"Lunchbot was not installed: {request.args['error']}"
+    if not is_valid_oauth_state(request.args.get("state", "")):
+        abort(401)
+
+    try:
+        oauth_response = await WebClient(base_url=slack_api_url, run_async=True).api_call(
+            "oauth.v2.access",
+            data={"client_id": slack_client_id, "client_secret": slack_client_secret, "code": request.args["code"]}
+        )
+    except SlackApiError as e:
+        errors.labels(request.path).inc()
+        logger.error(f"ERROR: {e}")
+        return "Lunchbot could not be installed, please try again."
+
+    installation = {
+        "_id": oauth_response["team"]["id"],
+        "team_name": oauth_response["team"]["name"],
+        "bot_token": oauth_response["access_token"],
+        "access_token": oauth_response.get("authed_user", {}).get("access_token"),
+        "installed_at": datetime.datetime.utcnow()
+    }
+    await store_installation(installation)
+    evict_installation(installation["_id"])
+    logger.info(f"Lunchbot installed to {installation['team_name']} ({installation['_id']}).")
+    return f"Lunchbot is installed to {installation['team_name']}, you can close this page."
+
+
+@app.route("/events", methods=["POST"])
+async def handle_events():
+    body = json_loads(await request.get_data())
+
+    if body["type"] == "url_verification":
+        return jsonify({"challenge": body["challenge"]})
+
+    event = body.get("event", {})
+    if event.get("type") in ("user_change", "team_join"):
+        get_user_directory(body["team_id"])["users"][event["user"]["id"]] = event["user"]
+    elif event.get("type") == "app_uninstalled":
+        await delete_installation(body["team_id"])
+        evict_installation(body["team_id"])
+        logger.info(f"Lunchbot uninstalled from {body['team_id']}.")
+    return 'OK'
+
+
 @app.route("/actions", methods=["POST"])
 async def handle_actions():
     request_values = await request.values
-    payload = json.loads(request_values["payload"])
+    payload = json_loads(request_values["payload"])
+
+    # acknowledge right away, the actual answer goes to slack through response_url
+    create_background_task(process_action(payload))
+    return 'OK'
 
+
+async def process_action(payload):
+    action_id = payload["actions"][0]["action_id"]
+    action = next((label for label in action_metric_labels if action_id.startswith(label)), "unknown")
+    with action_latency.labels(action).time():
+        await answer_action(payload)
+
+
+async def answer_action(payload):
+    team_id = payload["team"]["id"]
     if payload["actions"][0]["action_id"].startswith("confirm-add-restaurant"):
-        # TODO: handle multiple user submission
-        restaurant_to_add = db["temp"].find_one_and_delete({})
-        if payload["actions"][0]["action_id"] == "confirm-add-restaurant-true":
-            db["restaurants"].insert_one(
-                restaurant_to_add
-            )
-            logger.debug(f"Restaurant added to db: {restaurant_to_add}")
+        restaurant_to_add = await pop_pending_restaurant(team_id, payload["actions"][0]["value"])
+        if restaurant_to_add is None:
+            response = {
+                "response_type": "ephermal",
+                "replace_original": "true",
+                "text": "This restaurant confirmation has expired, please add the restaurant again."
+            }
+        elif payload["actions"][0]["action_id"] == "confirm-add-restaurant-true":
+            await add_restaurant(team_id, restaurant_to_add)
+            invalidate_restaurant_catalog(team_id)
+            logger.info(f"Restaurant added to db: {restaurant_to_add['name']}")
             response = {
                 "response_type": "ephermal",
                 "replace_original": "true",
@@ -175,12 +583,26 @@ async def handle_actions():
                 "text": f"Cancelled to add new restaurant."
             }
     elif payload["actions"][0]["action_id"] == "remove-restaurant":
-        restaurant_to_remove = remove_restaurant(payload["actions"][0]["value"])
-        response = get_response_for_remove_restaurant(restaurant_to_remove)
+        # the button carries the page it's on, so only that page is rendered again
+        restaurant_id, _, after = payload["actions"][0]["value"].partition(" ")
+        restaurant_to_remove = await remove_restaurant(team_id, restaurant_id)
+        invalidate_restaurant_catalog(team_id)
+        response = get_response_for_remove_restaurant(
+            restaurant_to_remove, await get_restaurant_catalog(team_id), after
+        )
+
+    elif payload["actions"][0]["action_id"].startswith("list-restaurants-page"):
+        response = {
+            "response_type": "ephermal",
+            "replace_original": "true",
+            "blocks": generate_restaurants_markdown(
+                await get_restaurant_catalog(team_id), payload["actions"][0]["value"]
+            )
+        }
 
     elif payload["actions"][0]["action_id"].startswith("answer-time-limit"):
-        if get_valid_session_for_user(payload["user"]["id"]):
-            store_time_limit(payload["user"]["id"], payload["actions"][0]["value"])
+        if await get_valid_session_for_user(team_id, payload["user"]["id"]):
+            await store_time_limit(team_id, payload["user"]["id"], payload["actions"][0]["value"])
 
             # ask for price limit
             response = get_response_for_answer_time_limit(payload['actions'][0]['value'])
@@ -188,86 +610,359 @@ async def handle_actions():
             response = get_response_for_invalid_session()
 
     elif payload["actions"][0]["action_id"].startswith("answer-price-limit"):
-        if get_valid_session_for_user(payload["user"]["id"]):
-            store_price_limit(payload["user"]["id"], payload["actions"][0]["value"])
+        if await get_valid_session_for_user(team_id, payload["user"]["id"]):
+            await store_price_limit(team_id, payload["user"]["id"], payload["actions"][0]["value"])
 
             # ask for tag exclude
-            response = get_response_for_answer_price_limit(payload["user"]["id"], payload["actions"][0]["value"])
+            response = await get_response_for_answer_price_limit(
+                team_id, payload["user"]["id"], payload["actions"][0]["value"]
+            )
         else:
             response = get_response_for_invalid_session()
 
     elif payload["actions"][0]["action_id"].startswith("answer-tag-exclude"):
-        if get_valid_session_for_user(payload["user"]["id"]):
-            store_excluded_tag(payload["user"]["id"], payload["actions"][0]["value"])
+        if await get_valid_session_for_user(team_id, payload["user"]["id"]):
+            await store_excluded_tag(team_id, payload["user"]["id"], payload["actions"][0]["value"])
 
             # show updated tag exclude question
-            response = get_response_for_answer_tag_exclude(payload["user"]["id"])
+            response = await get_response_for_answer_tag_exclude(team_id, payload["user"]["id"])
         else:
             response = get_response_for_invalid_session()
 
     elif payload["actions"][0]["action_id"].startswith("finish-tag-exclude"):
-        if get_valid_session_for_user(payload["user"]["id"]):
-            set_user_finished_session(payload["user"]["id"])
+        if await get_valid_session_for_user(team_id, payload["user"]["id"]):
+            session = await set_user_finished_session(team_id, payload["user"]["id"])
 
             # answer user to wait for others
             response = get_response_for_finish_tag_exclude()
+
+            # check whether all users are finished in this session
+            if session is not None and session["pending_count"] == 0:
+                # only the worker winning the claim sends the suggestions
+                session = await claim_session(session["_id"])
+                if session is not None:
+                    await send_suggested_restaurants_to_users(session)
+                    await delete_session(session["_id"])
         else:
             response = get_response_for_invalid_session()
 
-        # check whether all users are finished in this session
-        finished_session = get_finished_session_for_user(payload["user"]["id"])
+    elif payload["actions"][0]["action_id"] == "feedback-restaurant":
+        restaurant_id = payload["actions"][0]["selected_option"]["value"]
+        await store_visit(team_id, restaurant_id)
+        invalidate_restaurant_catalog(team_id)
+
+        # ask about the restaurant they went to
+        restaurant = find_catalog_restaurant(await get_restaurant_catalog(team_id), restaurant_id)
+        response = get_response_for_feedback(restaurant)
+
+    elif payload["actions"][0]["action_id"].startswith("feedback-"):
+        metric = payload["actions"][0]["action_id"][len("feedback-"):]
+        restaurant_id, _, value = payload["actions"][0]["selected_option"]["value"].partition(" ")
+        feedback_value = parse_feedback_value(metric, value)
+        # the payload comes from the client, only the metrics and options we offered are stored
+        if feedback_value is not None and bson.ObjectId.is_valid(restaurant_id):
+            await store_feedback(team_id, restaurant_id, payload["user"]["id"], metric, feedback_value)
+            invalidate_restaurant_catalog(team_id)
+
+            restaurant = find_catalog_restaurant(await get_restaurant_catalog(team_id), restaurant_id)
+            response = get_response_for_feedback(restaurant, metric, value)
+        else:
+            logger.warning(f"Rejected feedback {metric}={value} for restaurant {restaurant_id} from {payload['user']['id']}.")
+            response = get_response_for_invalid_feedback()
 
-        if finished_session:
-            send_suggested_restaurants_to_users(finished_session)
-            delete_session_for_user(payload["user"]["id"])
+    await post_to_response_url(payload["response_url"], response)
 
-    requests.post(payload["response_url"], json=response)
-    return 'OK'
+
+""" INSTALLATIONS """
+
+
+async def get_installation(team_id):
+    installation, expires_at = installation_cache.get(team_id, (None, 0))
+    if expires_at <= time.monotonic():
+        installation = await find_installation(team_id)
+        if installation is None and legacy_installation is not None and team_id == slack_team_id:
+            installation = legacy_installation
+        if installation is not None:
+            installation_cache[team_id] = (installation, time.monotonic() + installation_cache_ttl)
+    return installation
+
+
+def evict_installation(team_id):
+    installation_cache.pop(team_id, None)
+    user_directories.pop(team_id, None)
+    invalidate_restaurant_catalog(team_id)
+
+
+async def get_slack_client(team_id, is_bot=False):
+    installation = await get_installation(team_id)
+    if installation is None:
+        raise ValueError("Lunchbot is not installed!", team_id)
+    # oauth installs only have a user token if user scopes were asked for, the bot token can do the same
+    token = installation.get("access_token")
+    if is_bot or not token:
+        token = installation["bot_token"]
+
+    if token not in slack_clients:
+        slack_clients[token] = WebClient(token, base_url=slack_api_url, run_async=True)
+        if len(slack_clients) > slack_client_pool_size:
+            slack_clients.popitem(last=False)
+    slack_clients.move_to_end(token)
+    return slack_clients[token]
+
+
+def get_oauth_signature(timestamp):
+    return hmac.new(slack_signing_secret, b"oauth:" + timestamp.encode(), hashlib.sha256).hexdigest()
+
+
+def get_oauth_state():
+    # signed, so the callback can check it without storing anything
+    timestamp = str(int(time.time()))
+    return f"{timestamp}.{get_oauth_signature(timestamp)}"
+
+
+def is_valid_oauth_state(state):
+    timestamp, _, signature = state.partition(".")
+    if not slack_signing_secret or not timestamp.isdigit() or time.time() - int(timestamp) > oauth_state_max_age:
+        return False
+    return hmac.compare_digest(get_oauth_signature(timestamp), signature)
 
 
 """ SLACK API HELPER FUNCTIONS """
 
 
-async def slack_api(method, is_bot=False, **kwargs):
-    if is_bot:
-        api_call = await bot_client.api_call(method, **kwargs)
-    else:
-        api_call = await slack_client.api_call(method, **kwargs)
-    if api_call.get('ok'):
-        return api_call
-    else:
-        raise ValueError('Connection error!', api_call.get('error'), api_call.get('args'))
+async def slack_api(team_id, method, is_bot=False, **kwargs):
+    client = await get_slack_client(team_id, is_bot)
+    for attempt in range(slack_api_retries + 1):
+        await wait_for_slack_rate_limit(team_id, method, kwargs.get("json", {}).get("channel"))
+        slack_api_calls.labels(method).inc()
+        try:
+            api_call = await client.api_call(method, **kwargs)
+        except SlackApiError as e:
+            if e.response.status_code != 429 or attempt == slack_api_retries:
+                raise
+            # slack tells us how long to back off
+            retry_after = int(e.response.headers.get("Retry-After", 1))
+            slack_api_rate_limited.labels(method).inc()
+            logger.warning(f"Slack rate limited {method}, retrying in {retry_after}s.")
+            await asyncio.sleep(retry_after)
+            continue
+
+        if api_call.get('ok'):
+            return api_call
+        else:
+            raise ValueError('Connection error!', api_call.get('error'), api_call.get('args'))
+
+
+async def wait_for_slack_rate_limit(team_id, method, channel=None):
+    # token bucket per workspace and rate limit tier, shared by all methods in the tier,
+    # messages only wait for the ones posted to the same channel
+    tier = slack_method_tiers.get(method, 3)
+    calls_per_minute, burst = slack_rate_limit_tiers[tier]
+    rate = calls_per_minute / 60
+    key = (team_id, tier, channel) if tier == "special" else (team_id, tier)
+    bucket = slack_rate_limit_buckets.setdefault(key, {"tokens": burst, "updated_at": time.monotonic()})
+    slack_rate_limit_buckets.move_to_end(key)
+    while True:
+        now = time.monotonic()
+        bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated_at"]) * rate)
+        bucket["updated_at"] = now
+        if bucket["tokens"] >= 1:
+            bucket["tokens"] -= 1
+            bucket["full_at"] = now + (burst - bucket["tokens"]) / rate
+            break
+        await asyncio.sleep((1 - bucket["tokens"]) / rate)
+
+    while next(iter(slack_rate_limit_buckets.values()))["full_at"] <= now:
+        slack_rate_limit_buckets.popitem(last=False)
+
+
+def get_user_directory(team_id):
+    # never loaded yet, the monotonic clock can be below the ttl right after boot
+    return user_directories.setdefault(team_id, {"users": {}, "loaded_at": -math.inf})
+
+
+async def refresh_user_directory(team_id):
+    members = {}
+    cursor = ""
+    while True:
+        response = await slack_api(team_id, "users.list", params={"limit": 200, "cursor": cursor})
+        for user in response["members"]:
+            members[user["id"]] = user
+        cursor = response.get("response_metadata", {}).get("next_cursor", "")
+        if cursor == "":
+            break
+    user_directories[team_id] = {"users": members, "loaded_at": time.monotonic()}
+
+
+async def is_valid_user(team_id, user_id):
+    if time.monotonic() - get_user_directory(team_id)["loaded_at"] > user_directory_ttl:
+        async with user_directory_locks[team_id]:
+            # another request might have refreshed it while we were waiting
+            if time.monotonic() - get_user_directory(team_id)["loaded_at"] > user_directory_ttl:
+                await refresh_user_directory(team_id)
+
+    if user_id in get_user_directory(team_id)["users"]:
+        return True
+
+    # cache miss, the user might have joined since the last refresh
+    try:
+        response = await slack_api(team_id, "users.info", params={"user": user_id})
+    except (SlackApiError, ValueError):
+        return False
+    get_user_directory(team_id)["users"][user_id] = response["user"]
+    return True
 
 
-async def start_dm(user_id, blocks):
-    im_response = await slack_api("im.open", is_bot=True, json={"user": user_id})
+async def post_to_response_url(response_url, response):
+    for attempt in range(response_url_retries):
+        try:
+            async with http_session.post(response_url, json=response) as http_response:
+                # only server errors and rate limiting are worth retrying
+                if http_response.status < 500 and http_response.status != 429:
+                    return
+                logger.warning(f"response_url answered with {http_response.status} (attempt {attempt + 1})")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Could not post to response_url: {e} (attempt {attempt + 1})")
+        await asyncio.sleep(response_url_backoff * 2 ** attempt)
+    logger.error(f"Giving up posting to response_url after {response_url_retries} attempts.")
+
+
+""" DM DISPATCHER """
+
+
+async def get_dm_channel(team_id, user_id):
+    if (team_id, user_id) not in dm_channels:
+        im_response = await slack_api(team_id, "im.open", is_bot=True, json={"user": user_id})
+        dm_channels[team_id, user_id] = im_response["channel"]["id"]
+    return dm_channels[team_id, user_id]
+
+
+async def start_dm(team_id, user_id, blocks, post_at=None):
     args = {
-        "channel": im_response["channel"]["id"],
+        "channel": await get_dm_channel(team_id, user_id),
         "blocks": blocks
     }
-    await slack_api("chat.postMessage", is_bot=True, json=args)
+    try:
+        if post_at is None:
+            await slack_api(team_id, "chat.postMessage", is_bot=True, json=args)
+        else:
+            # slack holds scheduled messages, so they survive our restarts
+            await slack_api(team_id, "chat.scheduleMessage", is_bot=True, json={**args, "post_at": post_at})
+    except (SlackApiError, ValueError):
+        # the cached channel might not be valid anymore
+        dm_channels.pop((team_id, user_id), None)
+        raise
+
+
+async def enqueue_dm(team_id, user_id, blocks, post_at=None):
+    # waits when the queue is full, so a burst of lunches slows down instead of piling up tasks
+    await dm_queue.put((team_id, user_id, blocks, post_at))
+    dm_deliveries.labels("queued").inc()
+
+
+async def send_dms(team_id, user_ids, blocks, post_at=None):
+    for user_id in user_ids:
+        await enqueue_dm(team_id, user_id, blocks, post_at)
+
+
+async def process_dm_queue():
+    while True:
+        team_id, user_id, blocks, post_at = await dm_queue.get()
+        try:
+            await start_dm(team_id, user_id, blocks, post_at)
+            dm_deliveries.labels("sent").inc()
+        except Exception as e:
+            dm_deliveries.labels("failed").inc()
+            logger.error(f"ERROR: could not send DM to {user_id}: {e}")
+        finally:
+            dm_queue.task_done()
+
+
+""" SESSION SCHEDULER """
+
+
+def schedule_session_deadline(session_id, deadline):
+    heapq.heappush(session_deadlines, (deadline, session_id))
+    # wake the scheduler up in case this is the earliest deadline
+    session_deadlines_changed.set()
+
+
+async def expire_session(session_id):
+    session = await claim_expired_session(session_id)
+    if session is not None:
+        logger.info(f"Session {session_id} timed out with {session['pending_count']} user(s) pending.")
+        await send_suggested_restaurants_to_users(session)
+        await delete_session(session_id)
+
+
+async def run_session_deadlines():
+    # the heap is rebuilt from the db on start and on every rescan, so nothing is lost on restarts
+    rescan_at = time.monotonic()
+    while True:
+        if time.monotonic() >= rescan_at:
+            try:
+                session_deadlines[:] = await get_session_deadlines()
+                heapq.heapify(session_deadlines)
+            except pymongo.errors.PyMongoError as e:
+                logger.error(f"ERROR: could not load session deadlines: {e}")
+            rescan_at = time.monotonic() + session_deadline_rescan_interval
+
+        now = datetime.datetime.utcnow()
+        while len(session_deadlines) > 0 and session_deadlines[0][0] <= now:
+            _, session_id = heapq.heappop(session_deadlines)
+            try:
+                await expire_session(session_id)
+            except Exception as e:
+                logger.error(f"ERROR: could not expire session {session_id}: {e}")
+
+        timeout = rescan_at - time.monotonic()
+        if len(session_deadlines) > 0:
+            timeout = min(timeout, (session_deadlines[0][0] - datetime.datetime.utcnow()).total_seconds())
+        session_deadlines_changed.clear()
+        try:
+            await asyncio.wait_for(session_deadlines_changed.wait(), max(0, timeout))
+        except asyncio.TimeoutError:
+            pass
 
 
 """ SLACK BLOCK & RESPONSE GENERATOR FUNCTIONS """
 
 
-def generate_restaurants_markdown():
-    restaurants = list(db['restaurants'].find())
+def generate_restaurants_markdown(catalog, after):
+    # pages are addressed by the id of the restaurant before them ("first" for the first page),
+    # so they stay stable when restaurants are removed from other pages
+    restaurants = catalog["restaurants"]
+    start = 0 if after == "first" else bisect.bisect_right(catalog["ids"], bson.ObjectId(after))
+    if start >= len(restaurants):
+        # the page ran empty, e.g. its last restaurant was removed
+        start = max(0, len(restaurants) - restaurants_page_size)
+    end = min(start + restaurants_page_size, len(restaurants))
+
     restaurants_markdown = [
         {
             "type": "section",
             "text": {
                 "type": "mrkdwn",
-                "text": f"There are {len(restaurants)} restaurant(s) in Lunchbot's database:"
+                "text": f"There are {len(restaurants)} restaurant(s) in Lunchbot's database" +
+                    (f" (showing {start + 1}-{end}):" if len(restaurants) > 0 else ":")
             }
         },
         {
             "type": "divider"
         }
     ]
-    for i, restaurant in enumerate(restaurants):
+    for i in range(start, end):
+        restaurant = restaurants[i]
         restaurant_name_markdown = f"*{i+1}. {restaurant['name']}*\n"
-        restaurant_others_markdown = '\n'.join(get_prettyfied_dict(list(restaurant.items())[2:]))
+        restaurant_others_markdown = '\n'.join(get_prettyfied_dict(
+            (field, restaurant[field]) for field in restaurant_listed_fields if field in restaurant
+        ))
+        for metric in feedback_questions:
+            feedback_aggregate = get_feedback_aggregate(restaurant, metric)
+            if feedback_aggregate is not None:
+                mean, variance, count = feedback_aggregate
+                restaurant_others_markdown += \
+                    f"\n{metric} feedback: {mean:.1f} ± {math.sqrt(variance):.1f} ({count} vote(s))"
         restaurants_markdown.append({
             "type": "section",
             "text": {
@@ -285,7 +980,7 @@ def generate_restaurants_markdown():
                         "text": "Remove restaurant"
                     },
                     "action_id": "remove-restaurant",
-                    "value": str(restaurant["_id"]),
+                    "value": f"{restaurant['_id']} {after}",
                     "style": "danger",
                     "confirm": {
                         "title": {
@@ -304,11 +999,39 @@ def generate_restaurants_markdown():
                 }
             ]
         })
+
+    navigation = []
+    if start > 0:
+        previous_start = max(0, start - restaurants_page_size)
+        navigation.append({
+            "type": "button",
+            "text": {
+                "type": "plain_text",
+                "text": "Previous"
+            },
+            "action_id": "list-restaurants-page-previous",
+            "value": "first" if previous_start == 0 else str(catalog["ids"][previous_start - 1])
+        })
+    if end < len(restaurants):
+        navigation.append({
+            "type": "button",
+            "text": {
+                "type": "plain_text",
+                "text": "Next"
+            },
+            "action_id": "list-restaurants-page-next",
+            "value": str(catalog["ids"][end - 1])
+        })
+    if len(navigation) > 0:
+        restaurants_markdown.append({
+            "type": "actions",
+            "elements": navigation
+        })
+
     return restaurants_markdown
 
 
 def get_blocks_for_asking_time_limit(user_id):
-    # TODO: generate based on actual restaurant times and db["settings"].find_one({"name": "price_limit_step"})
     return [
         {
             "type": "section",
@@ -319,53 +1042,44 @@ def get_blocks_for_asking_time_limit(user_id):
                     "First, please give me how much time you have for lunch."
             }
         },
-        {
-            "type": "actions",
-            "elements": [
-                {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "20 min"
-                    },
-                    "value": "20",
-                    "action_id": "answer-time-limit-20"
-                },
-                {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "70 min"
-                    },
-                    "value": "70",
-                    "action_id": "answer-time-limit-70"
-                }
-            ]
-        }
+        get_block_for_time_limit_buttons()
     ]
 
 
-def get_blocks_for_asking_tag_exclude(user_id):
-    # getting tags dynamically from restaurants
-    tags_aggregated = list(db.restaurants.aggregate([
-        {
-            "$group": {
-                "_id": 0,
-                "tags": {
-                    "$push": "$tags"
-                }
-            }
-        },
-        {"$addFields": {
-            "tags": {
-                "$reduce": {
-                    "input": "$tags",
-                    "initialValue": [],
-                    "in": {"$setUnion": ["$$value", "$$this"]}
-                }
+# static blocks are built once and shared between responses, so they must never be mutated
+@functools.lru_cache(maxsize=None)
+def get_block_for_time_limit_buttons():
+    # TODO: generate based on actual restaurant times and db["settings"].find_one({"name": "price_limit_step"})
+    return {
+        "type": "actions",
+        "elements": [
+            {
+                "type": "button",
+                "text": {
+                    "type": "plain_text",
+                    "text": "20 min"
+                },
+                "value": "20",
+                "action_id": "answer-time-limit-20"
+            },
+            {
+                "type": "button",
+                "text": {
+                    "type": "plain_text",
+                    "text": "70 min"
+                },
+                "value": "70",
+                "action_id": "answer-time-limit-70"
             }
-        }}
-    ]))[0]["tags"]
+        ]
+    }
+
+
+async def get_blocks_for_asking_tag_exclude(team_id, user_id):
+    # getting tags from the maintained tag vocabulary
+    tags_aggregated = (await get_restaurant_catalog(team_id))["tags"]
+    # tags the user already filtered out, loaded at once
+    excluded_tags = await get_excluded_tags_for_user(team_id, user_id)
 
     # generate buttons based on aggregated tags
     elements = [
@@ -381,8 +1095,6 @@ def get_blocks_for_asking_tag_exclude(user_id):
         }
     ]
     for tag in tags_aggregated:
-        # checking whether user already filtered out that tag
-        query = db["filters"].find({"user_id": user_id, "tag_exclude": tag})
         element = {
                 "type": "button",
                 "text": {
@@ -392,7 +1104,7 @@ def get_blocks_for_asking_tag_exclude(user_id):
                 "value": tag,
                 "action_id": f"answer-tag-exclude-{tag}"
             }
-        if query.count() > 0:
+        if tag in excluded_tags:
             element["style"] = "danger"
         elements.append(
             element
@@ -414,8 +1126,27 @@ def get_blocks_for_asking_tag_exclude(user_id):
 
 
 def get_response_for_answer_time_limit(time_limit):
-    # TODO: generate based on actual restaurant prices and db["settings"].find_one({"name": "price_limit_step"})
     blocks_layout = [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f"Successfully chosen time limit as `{time_limit} minutes`."
+            }
+        },
+        *get_blocks_for_asking_price_limit()
+    ]
+    return {
+        "response_type": "ephermal",
+        "replace_original": "true",
+        "blocks": blocks_layout
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def get_blocks_for_asking_price_limit():
+    # TODO: generate based on actual restaurant prices and db["settings"].find_one({"name": "price_limit_step"})
+    return (
         {
             "type": "section",
             "text": {
@@ -446,26 +1177,12 @@ def get_response_for_answer_time_limit(time_limit):
                 }
             ]
         }
-    ]
-
-    blocks_layout.insert(0, {
-        "type": "section",
-        "text": {
-            "type": "mrkdwn",
-            "text": f"Successfully chosen time limit as `{time_limit} minutes`."
-        }
-    })
-    return {
-        "response_type": "ephermal",
-        "replace_original": "true",
-        "blocks": blocks_layout
-    }
+    )
 
 
-def get_response_for_add_restaurant_confirm(confirmation_answer):
+def get_response_for_add_restaurant_confirm(confirmation_answer, token):
     confirmation_answer_pretty = "\n".join(get_prettyfied_dict(confirmation_answer))
 
-    # TODO: solve multi-user submissions as well (sending some id to temp?)
     return {
         "response_type": "ephermal",
         "blocks": [
@@ -487,6 +1204,7 @@ def get_response_for_add_restaurant_confirm(confirmation_answer):
                             "text": "Add restaurant"
                         },
                         "style": "primary",
+                        "value": token,
                         "action_id": "confirm-add-restaurant-true"
                     },
                     {
@@ -496,6 +1214,7 @@ def get_response_for_add_restaurant_confirm(confirmation_answer):
                             "text": "Cancel"
                         },
                         "style": "danger",
+                        "value": token,
                         "action_id": "confirm-add-restaurant-false"
                     }
                 ]
@@ -510,10 +1229,35 @@ def get_response_for_add_restaurant_help():
         "text": """
 Usage: `/lunchbot-add-restaurant <"name"> <"address"> <initial duration in minutes> <initial rating 1-5> <initial price> <"tags" separated by spaces>`
 (e.g. `/lunchbot-add-restaurant "Suppé" "1065 Budapest, Hajós u. 19." 30 4 1100 hash-house small-place`)
+The duration is the time spent eating, walking there and back is added from the restaurant's location.
+The location is looked up by the address, or can be given among the tags as `@<latitude>,<longitude>`
+(e.g. `@47.5029,19.0573`).
+"""
+    }
+
+
+def get_response_for_import_restaurants_help():
+    return {
+        "response_type": "ephermal",
+        "text": f"""
+Usage: `/lunchbot-import-restaurants <URL of a .csv or .jsonl file uploaded to Slack>`
+CSV files need a header with the columns `{', '.join(restaurant_import_fields)}` (tags separated by spaces),
+JSON lines files need one object per line with the same keys. Restaurants with an existing name are updated.
+The columns `{', '.join(restaurant_import_location_fields)}` are optional, without them the address is geocoded.
 """
     }
 
 
+def get_response_for_import_restaurants_result(counts, import_errors):
+    text = f"Imported {counts['imported']} restaurant(s), skipped {counts['invalid']} invalid row(s)."
+    if len(import_errors) > 0:
+        text += "\n" + "\n".join(f"• {import_error}" for import_error in import_errors)
+    return {
+        "response_type": "ephermal",
+        "text": text
+    }
+
+
 def get_response_for_add_restaurant_few_arguments():
     return {
         "response_type": "ephermal",
@@ -521,9 +1265,7 @@ def get_response_for_add_restaurant_few_arguments():
     }
 
 
-def get_blocks_for_suggested_restaurants(suggested_restaurants):
-    suggested_restaurants = list(suggested_restaurants)
-
+def get_blocks_for_suggested_restaurants(suggested_restaurants, timed_out_user_ids=()):
     if len(suggested_restaurants) > 0:
         blocks_layout = [{
             "type": "section",
@@ -553,20 +1295,42 @@ def get_blocks_for_suggested_restaurants(suggested_restaurants):
             }
         }]
 
+    if len(timed_out_user_ids) > 0:
+        blocks_layout.insert(0, {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f"{', '.join(f'<@{user_id}>' for user_id in timed_out_user_ids)} didn't answer in time, " +
+                    "so only the others' inputs were taken into account."
+            }
+        })
+
     return blocks_layout
 
 
-def get_response_for_answer_tag_exclude(user_id):
-    blocks_layout = get_blocks_for_asking_tag_exclude(user_id)
-    return {
-        "response_type": "ephermal",
-        "replace_original": "true",
-        "blocks": blocks_layout
+@functools.lru_cache(maxsize=None)
+def get_blocks_for_timed_out_session():
+    return [{
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": "The lunch suggestion session timed out, nobody answered in time. " +
+                "Why not start another one with the `/lunchbot-suggest` command?"
+        }
+    }]
+
+
+async def get_response_for_answer_tag_exclude(team_id, user_id):
+    blocks_layout = await get_blocks_for_asking_tag_exclude(team_id, user_id)
+    return {
+        "response_type": "ephermal",
+        "replace_original": "true",
+        "blocks": blocks_layout
     }
 
 
-def get_response_for_answer_price_limit(user_id, price_limit):
-    blocks_layout = get_blocks_for_asking_tag_exclude(user_id)
+async def get_response_for_answer_price_limit(team_id, user_id, price_limit):
+    blocks_layout = await get_blocks_for_asking_tag_exclude(team_id, user_id)
     blocks_layout.insert(0, {
         "type": "section",
         "text": {
@@ -582,14 +1346,110 @@ def get_response_for_answer_price_limit(user_id, price_limit):
     }
 
 
-def get_response_for_remove_restaurant(restaurant_to_remove):
-    blocks_layout = generate_restaurants_markdown()
+def get_response_for_remove_restaurant(restaurant_to_remove, catalog, after):
+    blocks_layout = generate_restaurants_markdown(catalog, after)
+    # somebody else may have removed it already, the list is rendered again either way
+    if restaurant_to_remove is not None:
+        message = f"Successfully removed restaurant `{restaurant_to_remove['name']}`."
+    else:
+        message = "Sorry, this restaurant was not found. It may have been removed already."
     blocks_layout.append({
         "type": "section",
         "text": {
             "type": "mrkdwn",
-            "text": f"Successfully removed restaurant `{restaurant_to_remove['name']}`."
+            "text": message
+        }
+    })
+
+    return {
+        "response_type": "ephermal",
+        "replace_original": "true",
+        "blocks": blocks_layout
+    }
+
+
+def get_blocks_for_asking_feedback(suggested_restaurants):
+    return [
+        {
+            "type": "section",
+            "text": {
+                "type": "plain_text",
+                "text": "How was lunch? Please, tell me where you went, so I can give better suggestions next time."
+            }
+        },
+        {
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "static_select",
+                    "placeholder": {
+                        "type": "plain_text",
+                        "text": "Restaurant"
+                    },
+                    "action_id": "feedback-restaurant",
+                    "options": [
+                        {
+                            "text": {
+                                "type": "plain_text",
+                                "text": restaurant["name"][:75]
+                            },
+                            "value": str(restaurant["_id"])
+                        }
+                        for restaurant in suggested_restaurants
+                    ]
+                }
+            ]
+        }
+    ]
+
+
+def get_response_for_feedback(restaurant, answered_metric=None, answered_value=None):
+    if restaurant is None:
+        return {
+            "response_type": "ephermal",
+            "replace_original": "true",
+            "text": "Sorry, this restaurant is not in Lunchbot's database anymore."
+        }
+
+    blocks_layout = [{
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": f"How was *{restaurant['name']}*?"
         }
+    }]
+    if answered_metric is not None:
+        question = feedback_questions[answered_metric]
+        blocks_layout.append({
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f"Thanks, saved {answered_metric} as `{answered_value}{question['unit']}`."
+            }
+        })
+    blocks_layout.append({
+        "type": "actions",
+        "elements": [
+            {
+                "type": "static_select",
+                "placeholder": {
+                    "type": "plain_text",
+                    "text": question["label"]
+                },
+                "action_id": f"feedback-{metric}",
+                "options": [
+                    {
+                        "text": {
+                            "type": "plain_text",
+                            "text": f"{option}{question['unit']}"
+                        },
+                        "value": f"{restaurant['_id']} {option}"
+                    }
+                    for option in question["options"]
+                ]
+            }
+            for metric, question in feedback_questions.items()
+        ]
     })
 
     return {
@@ -599,6 +1459,7 @@ def get_response_for_remove_restaurant(restaurant_to_remove):
     }
 
 
+@functools.lru_cache(maxsize=None)
 def get_response_for_finish_tag_exclude():
     blocks_layout = [{
         "type": "section",
@@ -614,6 +1475,7 @@ def get_response_for_finish_tag_exclude():
     }
 
 
+@functools.lru_cache(maxsize=None)
 def get_response_for_invalid_session():
     blocks_layout = [{
         "type": "section",
@@ -630,162 +1492,1008 @@ def get_response_for_invalid_session():
     }
 
 
+@functools.lru_cache(maxsize=None)
+def get_response_for_invalid_feedback():
+    blocks_layout = [{
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": "Sorry, this answer is not valid. Please choose one of the options."
+        }
+    }]
+    return {
+        "response_type": "ephermal",
+        "replace_original": "false",
+        "blocks": blocks_layout
+    }
+
+
+""" RESTAURANT CATALOG """
+
+
+def get_feedback_aggregate(restaurant, metric):
+    # mean and variance from the running count, sum and sum of squares kept on the restaurant
+    aggregate = restaurant.get("feedback", {}).get(metric)
+    if aggregate is None or aggregate["count"] == 0:
+        return None
+    mean = aggregate["sum"] / aggregate["count"]
+    variance = max(0, aggregate["sum_sq"] / aggregate["count"] - mean ** 2)
+    return mean, variance, aggregate["count"]
+
+
+def get_effective_value(restaurant, metric):
+    # feedback overrides the value given when the restaurant was added
+    feedback_aggregate = get_feedback_aggregate(restaurant, metric)
+    return restaurant[f"initial {metric}"] if feedback_aggregate is None else feedback_aggregate[0]
+
+
+def get_catalog_offices():
+    # without configured offices walking time is not taken into account
+    return list(offices) if len(offices) > 0 else [None]
+
+
+def build_restaurant_catalog(restaurants, tags):
+    catalog_offices = get_catalog_offices()
+    for restaurant in restaurants:
+        for metric in feedback_questions:
+            restaurant[f"effective {metric}"] = get_effective_value(restaurant, metric)
+        restaurant["walking minutes"] = {office: get_walking_minutes(restaurant, office) for office in catalog_offices}
+
+    # bit i of a bitset stands for restaurants[i]
+    tag_bitsets = {}
+    for i, restaurant in enumerate(restaurants):
+        for tag in restaurant.get("tags", []):
+            tag_bitsets[tag] = tag_bitsets.get(tag, 0) | 1 << i
+
+    # walking there and back plus eating, from each office
+    total_times = {
+        office: [get_total_time(restaurant, [office]) for restaurant in restaurants] for office in catalog_offices
+    }
+    by_total_time = {
+        office: sorted(range(len(restaurants)), key=lambda i: office_total_times[i])
+        for office, office_total_times in total_times.items()
+    }
+    by_price = sorted(range(len(restaurants)), key=lambda i: restaurants[i]["effective price"])
+
+    return {
+        "restaurants": restaurants,
+        "columns": build_restaurant_columns(restaurants, tag_bitsets, catalog_offices) if np is not None else None,
+        "ids": [restaurant["_id"] for restaurant in restaurants],
+        # most used tags first
+        "tags": tags,
+        "all_bitset": (1 << len(restaurants)) - 1,
+        "tag_bitsets": tag_bitsets,
+        "by_total_time": by_total_time,
+        "total_times": {
+            office: [total_times[office][i] for i in order] for office, order in by_total_time.items()
+        },
+        "by_price": by_price,
+        "prices": [restaurants[i]["effective price"] for i in by_price],
+        "loaded_at": time.monotonic()
+    }
+
+
+def build_restaurant_columns(restaurants, tag_bitsets, catalog_offices):
+    # column-oriented copy of the catalog for vectorized matching and scoring
+    tag_indices = {tag: i for i, tag in enumerate(tag_bitsets)}
+    tag_matrix = np.zeros((len(restaurants), len(tag_indices)), dtype=bool)
+    for i, restaurant in enumerate(restaurants):
+        for tag in restaurant.get("tags", []):
+            tag_matrix[i, tag_indices[tag]] = True
+
+    return {
+        "durations": np.array([restaurant["effective duration"] for restaurant in restaurants], dtype=float),
+        "walking_minutes": get_column_walking_minutes(restaurants, catalog_offices),
+        "prices": np.array([restaurant["effective price"] for restaurant in restaurants], dtype=float),
+        "ratings": np.array([restaurant["effective rating"] for restaurant in restaurants], dtype=float),
+        # nan for restaurants never visited
+        "last_visited": np.array([
+            restaurant["last visited"].replace(tzinfo=datetime.timezone.utc).timestamp()
+            if restaurant.get("last visited") is not None else np.nan
+            for restaurant in restaurants
+        ], dtype=float),
+        "tag_indices": tag_indices,
+        # one row of packed bits per restaurant
+        "tags": np.packbits(tag_matrix, axis=1)
+    }
+
+
+def is_restaurant_catalog_outdated(restaurant_catalog):
+    return restaurant_catalog is None or (
+        not restaurant_change_stream_active and
+        time.monotonic() - restaurant_catalog["loaded_at"] > restaurant_catalog_poll_interval
+    )
+
+
+async def get_restaurant_catalog(team_id):
+    restaurant_catalog = restaurant_catalogs.get(team_id)
+    if is_restaurant_catalog_outdated(restaurant_catalog):
+        async with restaurant_catalog_locks[team_id]:
+            # another request might have rebuilt it while we were waiting
+            restaurant_catalog = restaurant_catalogs.get(team_id)
+            if is_restaurant_catalog_outdated(restaurant_catalog):
+                generation = restaurant_catalog_generations[team_id]
+                restaurant_catalog = build_restaurant_catalog(
+                    await get_restaurants(team_id), await get_tag_vocabulary(team_id)
+                )
+                # a write during the rebuild may be missing from it, the next request rebuilds it again
+                if restaurant_catalog_generations[team_id] == generation:
+                    restaurant_catalogs[team_id] = restaurant_catalog
+    return restaurant_catalog
+
+
+def find_catalog_restaurant(catalog, restaurant_id):
+    restaurant_id = bson.ObjectId(restaurant_id)
+    i = bisect.bisect_left(catalog["ids"], restaurant_id)
+    if i < len(catalog["ids"]) and catalog["ids"][i] == restaurant_id:
+        return catalog["restaurants"][i]
+    return None
+
+
+def invalidate_restaurant_catalog(team_id=None):
+    # without a team every catalog is dropped
+    if team_id is None:
+        restaurant_catalogs.clear()
+        for generation_team_id in restaurant_catalog_generations:
+            restaurant_catalog_generations[generation_team_id] += 1
+    else:
+        restaurant_catalogs.pop(team_id, None)
+        restaurant_catalog_generations[team_id] += 1
+
+
+def watch_restaurant_changes(loop):
+    # runs on its own thread since iterating a change stream blocks
+    global restaurant_change_stream_active
+    try:
+        with db["restaurants"].watch(full_document="updateLookup") as change_stream:
+            restaurant_change_stream_active = True
+            # changes might have happened before the stream was opened
+            loop.call_soon_threadsafe(invalidate_restaurant_catalog)
+            for change in change_stream:
+                # deletes only carry the id, so they drop the catalog of every team
+                team_id = (change.get("fullDocument") or {}).get("team_id")
+                loop.call_soon_threadsafe(invalidate_restaurant_catalog, team_id)
+    except pymongo.errors.PyMongoError as e:
+        logger.info(
+            f"Restaurant change stream is not available, polling every {restaurant_catalog_poll_interval}s: {e}"
+        )
+    restaurant_change_stream_active = False
+
+
+def get_bitset_within_limit(order, values, limit, all_bitset):
+    if limit is None:
+        return all_bitset
+    bitset = 0
+    for i in order[:bisect.bisect_right(values, limit)]:
+        bitset |= 1 << i
+    return bitset
+
+
+def match_restaurants(catalog, filters):
+    candidates = catalog["all_bitset"]
+    for office, min_time in filters["min_time_by_office"].items():
+        candidates &= get_bitset_within_limit(
+            catalog["by_total_time"][office], catalog["total_times"][office], min_time, catalog["all_bitset"]
+        )
+    candidates &= get_bitset_within_limit(
+        catalog["by_price"], catalog["prices"], filters["min_price"], catalog["all_bitset"]
+    )
+    for tag in filters["excluded_tags"]:
+        candidates &= ~catalog["tag_bitsets"].get(tag, 0)
+
+    return [restaurant for i, restaurant in enumerate(catalog["restaurants"]) if candidates >> i & 1]
+
+
+def get_group_filters(users):
+    # the group is limited by its strictest member, users who never set a limit don't restrict it
+    time_limits = [user["time_limit"] for user in users if "time_limit" in user]
+    price_limits = [user["price_limit"] for user in users if "price_limit" in user]
+    # walking time depends on where the users start from, so time limits are kept per office
+    min_time_by_office = {}
+    for user in users:
+        if "time_limit" in user:
+            office = get_office_for_user(user["user_id"])
+            min_time_by_office[office] = min(user["time_limit"], min_time_by_office.get(office, user["time_limit"]))
+    return {
+        "min_time": min(time_limits, default=None),
+        "min_time_by_office": min_time_by_office,
+        # scores are based on the office farthest from the restaurant
+        "offices": {get_office_for_user(user["user_id"]) for user in users},
+        "min_price": min(price_limits, default=None),
+        "excluded_tags": set().union(*(user.get("excluded_tags", []) for user in users))
+    }
+
+
+def get_headroom(value, limit):
+    # how much of the limit is left, between 0 and 1
+    if limit is None or limit <= 0:
+        return 0
+    return max(0, min(1, (limit - value) / limit))
+
+
+def score_restaurant(restaurant, filters, now):
+    score = suggestion_weights["rating"] * restaurant["effective rating"] / 5
+    score += suggestion_weights["price"] * get_headroom(restaurant["effective price"], filters["min_price"])
+    score += suggestion_weights["duration"] * get_headroom(
+        get_total_time(restaurant, filters["offices"]), filters["min_time"]
+    )
+
+    # restaurants visited recently are pushed back, fading out over suggestion_recency_days
+    if restaurant.get("last visited") is not None:
+        days_since_visit = (now - restaurant["last visited"]).total_seconds() / (24 * 60 * 60)
+        score -= suggestion_weights["recency"] * max(0, 1 - days_since_visit / suggestion_recency_days)
+
+    return score
+
+
+def rank_restaurants(restaurants, filters, limit):
+    now = datetime.datetime.utcnow()
+    return heapq.nlargest(limit, restaurants, key=lambda restaurant: score_restaurant(restaurant, filters, now))
+
+
+def get_column_headroom(values, limit):
+    if limit is None or limit <= 0:
+        return np.zeros_like(values)
+    return np.clip((limit - values) / limit, 0, 1)
+
+
+def match_and_rank_restaurant_columns(catalog, filters, limit):
+    columns = catalog["columns"]
+
+    candidates = np.ones(len(catalog["restaurants"]), dtype=bool)
+    for office, min_time in filters["min_time_by_office"].items():
+        candidates &= columns["durations"] + 2 * columns["walking_minutes"][office] <= min_time
+    if filters["min_price"] is not None:
+        candidates &= columns["prices"] <= filters["min_price"]
+    excluded_tags = [columns["tag_indices"][tag] for tag in filters["excluded_tags"] if tag in columns["tag_indices"]]
+    if len(excluded_tags) > 0:
+        excluded_mask = np.zeros(len(columns["tag_indices"]), dtype=bool)
+        excluded_mask[excluded_tags] = True
+        candidates &= ~(columns["tags"] & np.packbits(excluded_mask)).any(axis=1)
+
+    indices = np.flatnonzero(candidates)
+    scores = suggestion_weights["rating"] * columns["ratings"][indices] / 5
+    scores += suggestion_weights["price"] * get_column_headroom(columns["prices"][indices], filters["min_price"])
+    round_trips = 2 * np.max(
+        [columns["walking_minutes"][office][indices] for office in filters["offices"]] or [np.zeros(len(indices))],
+        axis=0
+    )
+    scores += suggestion_weights["duration"] * get_column_headroom(
+        columns["durations"][indices] + round_trips, filters["min_time"]
+    )
+    days_since_visit = (time.time() - columns["last_visited"][indices]) / (24 * 60 * 60)
+    scores -= suggestion_weights["recency"] * np.nan_to_num(
+        np.clip(1 - days_since_visit / suggestion_recency_days, 0, None)
+    )
+
+    # only the best ones are sorted
+    if len(indices) > limit:
+        best = np.argpartition(-scores, limit)[:limit]
+        indices, scores = indices[best], scores[best]
+    return [catalog["restaurants"][i] for i in indices[np.argsort(-scores, kind="stable")]]
+
+
+async def get_suggested_restaurants(team_id, users):
+    filters = get_group_filters(users)
+    catalog = await get_restaurant_catalog(team_id)
+    if catalog["columns"] is not None:
+        return match_and_rank_restaurant_columns(catalog, filters, suggestion_limit)
+
+    candidates = match_restaurants(catalog, filters)
+    return rank_restaurants(candidates, filters, suggestion_limit)
+
+
+""" GEOGRAPHY """
+
+
+def get_office_for_user(user_id):
+    return user_offices.get(user_id, default_office)
+
+
+def get_office_coordinates(office):
+    latitude, longitude = offices[office]["location"]
+    return latitude, longitude
+
+
+def get_restaurant_coordinates(restaurant):
+    # stored as geojson, so longitude comes first
+    longitude, latitude = restaurant["location"]["coordinates"]
+    return latitude, longitude
+
+
+def get_distance(latitude_a, longitude_a, latitude_b, longitude_b):
+    # haversine distance in km
+    latitude_a, longitude_a, latitude_b, longitude_b = map(
+        math.radians, (latitude_a, longitude_a, latitude_b, longitude_b)
+    )
+    a = math.sin((latitude_b - latitude_a) / 2) ** 2 + \
+        math.cos(latitude_a) * math.cos(latitude_b) * math.sin((longitude_b - longitude_a) / 2) ** 2
+    return 2 * 6371 * math.asin(math.sqrt(a))
+
+
+def get_walking_minutes(restaurant, office):
+    # restaurants without a location are assumed to be next door
+    if office is None or restaurant.get("location") is None:
+        return 0
+    distance = get_distance(*get_restaurant_coordinates(restaurant), *get_office_coordinates(office))
+    return distance * walking_detour_factor / walking_speed * 60
+
+
+def get_total_time(restaurant, restaurant_offices):
+    # walking there and back plus eating, from the farthest of the offices
+    walking_minutes = max((restaurant["walking minutes"][office] for office in restaurant_offices), default=0)
+    return restaurant["effective duration"] + 2 * walking_minutes
+
+
+def get_column_walking_minutes(restaurants, catalog_offices):
+    # vectorized haversine, nan coordinates mark restaurants without a location
+    coordinates = np.radians(np.array([
+        get_restaurant_coordinates(restaurant) if restaurant.get("location") is not None else (np.nan, np.nan)
+        for restaurant in restaurants
+    ], dtype=float).reshape(-1, 2))
+    walking_minutes = {}
+    for office in catalog_offices:
+        if office is None:
+            walking_minutes[office] = np.zeros(len(restaurants))
+            continue
+        office_latitude, office_longitude = np.radians(get_office_coordinates(office))
+        a = np.sin((coordinates[:, 0] - office_latitude) / 2) ** 2 + \
+            np.cos(coordinates[:, 0]) * np.cos(office_latitude) * np.sin((coordinates[:, 1] - office_longitude) / 2) ** 2
+        distances = 2 * 6371 * np.arcsin(np.sqrt(a))
+        walking_minutes[office] = np.nan_to_num(distances * walking_detour_factor / walking_speed * 60)
+    return walking_minutes
+
+
+def get_point(latitude, longitude):
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("coordinates are out of range")
+    return {"type": "Point", "coordinates": [longitude, latitude]}
+
+
+def parse_location(text):
+    # "<latitude>,<longitude>"
+    latitude, longitude = text.split(",")
+    return get_point(float(latitude), float(longitude))
+
+
+def normalize_address(address):
+    return " ".join(address.lower().replace(",", " ").split())
+
+
+def load_geocoding_table():
+    global geocoding_table
+    if geocoding_table_path is None:
+        return
+    try:
+        with open(geocoding_table_path, encoding="utf-8") as file:
+            geocoding_table = {
+                normalize_address(row["address"]): get_point(float(row["latitude"]), float(row["longitude"]))
+                for row in csv.DictReader(file)
+            }
+    except FileNotFoundError:
+        logger.error(f"ERROR: geocoding table {geocoding_table_path} not found, addresses won't be geocoded.")
+        return
+    logger.info(f"Geocoding table loaded with {len(geocoding_table)} addresses.")
+
+
+def geocode(address):
+    # offline lookup, no map service is called while handling requests
+    return geocoding_table.get(normalize_address(address))
+
+
 """ DB FUNCTIONS """
 
 
-def get_suggested_restaurants(user_ids):
-    # get filters from db
-    time_limit = list(db.filters.aggregate([
+def db_function(func):
+    # run the blocking pymongo call on the db executor so it doesn't stall the event loop
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        with db_latency.labels(func.__name__).time():
+            return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+    return wrapper
+
+
+@db_function
+def get_restaurants(team_id):
+    # sorted by id, so pages can be found by bisecting the ids
+    return list(db["restaurants"].find({"team_id": team_id}, restaurant_fields).sort("_id", pymongo.ASCENDING))
+
+
+@db_function
+def get_excluded_tags_for_user(team_id, user_id):
+    session = db["sessions"].find_one(
+        {"team_id": team_id, "users.user_id": user_id},
+        {"users": {"$elemMatch": {"user_id": user_id}}}
+    )
+    if session is None:
+        return set()
+    return set(session["users"][0].get("excluded_tags", []))
+
+
+@db_function
+def ensure_indexes():
+    # every query is scoped to a team, so the indexes start with the team id
+    db["sessions"].create_index("created_at", expireAfterSeconds=session_ttl)
+    db["sessions"].create_index([("team_id", pymongo.ASCENDING), ("users.user_id", pymongo.ASCENDING)])
+    # except for the scheduler, which finishes the sessions of every team
+    db["sessions"].create_index("deadline")
+    db["pending_restaurants"].create_index("created_at", expireAfterSeconds=pending_restaurant_ttl)
+    db["restaurants"].create_index([("team_id", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+    db["restaurants"].create_index([("team_id", pymongo.ASCENDING), ("name", pymongo.ASCENDING)])
+    db["restaurants"].create_index([("team_id", pymongo.ASCENDING), ("location", pymongo.GEOSPHERE)])
+    db["tags"].create_index([("team_id", pymongo.ASCENDING), ("tag", pymongo.ASCENDING)], unique=True)
+    db["tags"].create_index([("team_id", pymongo.ASCENDING), ("count", pymongo.DESCENDING)])
+    db["ratings"].create_index([
+        ("team_id", pymongo.ASCENDING),
+        ("restaurant_id", pymongo.ASCENDING),
+        ("user_id", pymongo.ASCENDING),
+        ("metric", pymongo.ASCENDING)
+    ], unique=True)
+
+
+@db_function
+def migrate_legacy_documents(team_id):
+    # only restaurants and sessions were stored before multi-workspace support
+    if team_id is None:
+        # the old documents would be invisible to every workspace, so the team has to be given
+        for collection in ["restaurants", "sessions"]:
+            if db[collection].find_one({"team_id": {"$exists": False}}, {"_id": 1}) is not None:
+                raise ValueError(f"{collection} from before multi-workspace support need SLACK_TEAM_ID to be set!")
+        return
+    for collection in ["restaurants", "sessions"]:
+        result = db[collection].update_many({"team_id": {"$exists": False}}, {"$set": {"team_id": team_id}})
+        if result.modified_count > 0:
+            logger.info(f"Assigned {result.modified_count} document(s) in {collection} to team {team_id}.")
+
+
+@db_function
+def store_excluded_tag(team_id, user_id, excluded_tag):
+    # store excluded tag to user in the session
+    # if the tag is already there, we should remove it (to mimic button switch)
+    pull_result = db["sessions"].update_one(
         {
-            "$match": {
-                "user_id": {"$in": user_ids},
-                "time_limit": {"$exists": 1}
-            }
+            "team_id": team_id,
+            "users": {"$elemMatch": {"user_id": user_id, "excluded_tags": excluded_tag}},
+            "status": "collecting"
         },
         {
-            "$group": {
-                "_id": 0,
-                "min_time": {"$min": "$time_limit"}
-            }
+            "$pull": {"users.$.excluded_tags": excluded_tag}
         }
-    ]))[0]["min_time"]
+    )
+    if pull_result.modified_count == 0:
+        db["sessions"].update_one(
+            {
+                "team_id": team_id,
+                "users": {"$elemMatch": {"user_id": user_id}},
+                "status": "collecting"
+            },
+            {
+                "$addToSet": {"users.$.excluded_tags": excluded_tag}
+            }
+        )
 
-    price_limit = list(db.filters.aggregate([
+
+@db_function
+def store_price_limit(team_id, user_id, price_limit):
+    # store price limit value to user in the session (replace if exists)
+    db["sessions"].update_one(
         {
-            "$match": {
-                "user_id": {"$in": user_ids},
-                "price_limit": {"$exists": 1}
-            }
+            "team_id": team_id,
+            "users": {"$elemMatch": {"user_id": user_id}},
+            "status": "collecting"
         },
         {
-            "$group": {
-                "_id": None,
-                "min_price": {"$min": "$price_limit"}
-            }
+            "$set": {"users.$.price_limit": int(price_limit)}
         }
-    ]))[0]["min_price"]
+    )
 
-    excluded_tags_result = list(db.filters.aggregate([
+
+@db_function
+def store_time_limit(team_id, user_id, time_limit):
+    # store time limit value to user in the session (replace if exists)
+    db["sessions"].update_one(
         {
-            "$match": {
-                "user_id": {"$in": user_ids},
-                "tag_exclude": {"$exists": 1}
-            }
+            "team_id": team_id,
+            "users": {"$elemMatch": {"user_id": user_id}},
+            "status": "collecting"
         },
         {
-            "$group": {
-                "_id": None,
-                "tags": {"$push": "$tag_exclude"}
-            }
+            "$set": {"users.$.time_limit": int(time_limit)}
         }
+    )
+
+
+@db_function
+def remove_restaurant(team_id, restaurant_id):
+    restaurant_to_remove = db["restaurants"].find_one_and_delete(
+        {"_id": bson.ObjectId(restaurant_id), "team_id": team_id}
+    )
+    if restaurant_to_remove is not None:
+        update_tag_vocabulary(team_id, {tag: -1 for tag in restaurant_to_remove.get("tags", [])})
+        logger.info(f"Restaurant removed from db: {restaurant_to_remove['name']}")
+    return restaurant_to_remove
+
+
+@db_function
+def add_restaurant(team_id, restaurant):
+    db["restaurants"].insert_one({**restaurant, "team_id": team_id})
+    update_tag_vocabulary(team_id, {tag: 1 for tag in restaurant.get("tags", [])})
+
+
+def update_tag_vocabulary(team_id, tag_increments):
+    # not a db_function on its own, it's called from the write paths already running on the executor,
+    # counts are only ever incremented, so concurrent writes don't lose each other's changes
+    tag_increments = {tag: increment for tag, increment in tag_increments.items() if increment != 0}
+    if len(tag_increments) == 0:
+        return
+    db["tags"].bulk_write([
+        pymongo.UpdateOne({"team_id": team_id, "tag": tag}, {"$inc": {"count": increment}}, upsert=True)
+        for tag, increment in tag_increments.items()
+    ])
+    db["tags"].delete_many({"team_id": team_id, "count": {"$lte": 0}})
+
+
+@db_function
+def upsert_restaurants(team_id, restaurants):
+    # the last row wins if a name is repeated in the batch
+    restaurants = list({restaurant["name"]: restaurant for restaurant in restaurants}.values())
+    previous_tags = {
+        restaurant["name"]: restaurant.get("tags", []) for restaurant in db["restaurants"].find(
+            {"team_id": team_id, "name": {"$in": [restaurant["name"] for restaurant in restaurants]}}, ["name", "tags"]
+        )
+    }
+    db["restaurants"].bulk_write([
+        pymongo.UpdateOne({"team_id": team_id, "name": restaurant["name"]}, {"$set": restaurant}, upsert=True)
+        for restaurant in restaurants
+    ], ordered=False)
+    # only the tags that changed are counted, the vocabulary is never emptied for a rebuild
+    tag_increments = collections.Counter()
+    for restaurant in restaurants:
+        tag_increments.update(set(restaurant["tags"]))
+        tag_increments.subtract(set(previous_tags.get(restaurant["name"], [])))
+    update_tag_vocabulary(team_id, tag_increments)
+
+
+@db_function
+def get_tag_vocabulary(team_id):
+    return [
+        tag["tag"] for tag in
+        db["tags"].find({"team_id": team_id}).sort([("count", pymongo.DESCENDING), ("tag", pymongo.ASCENDING)])
+    ]
+
+
+@db_function
+def rebuild_tag_vocabulary(team_id):
+    # $out would replace the tags of every team, so only the counts are aggregated
+    counts = list(db["restaurants"].aggregate([
+        {"$match": {"team_id": team_id}},
+        {"$unwind": "$tags"},
+        {"$group": {"_id": "$tags", "count": {"$sum": 1}}}
     ]))
-    excluded_tags = excluded_tags_result[0]["tags"] if len(excluded_tags_result) > 0 else []
+    # counts are replaced in place, so the vocabulary is never empty while it's rebuilt
+    if len(counts) > 0:
+        db["tags"].bulk_write([
+            pymongo.UpdateOne(
+                {"team_id": team_id, "tag": count["_id"]}, {"$set": {"count": count["count"]}}, upsert=True
+            )
+            for count in counts
+        ])
+    db["tags"].delete_many({"team_id": team_id, "tag": {"$nin": [count["_id"] for count in counts]}})
 
-    # get restaurants from db based on filters
-    return list(db["restaurants"].find({
-        "initial duration": {"$lte": time_limit},
-        "initial price": {"$lte": price_limit},
-        "tags": {"$nin": excluded_tags}
-    }))
 
+@db_function
+def is_tag_vocabulary_empty(team_id):
+    return db["tags"].find_one({"team_id": team_id}) is None
 
-def store_excluded_tag(user_id, excluded_tag):
-    # store excluded tag to user in db
-    # if the tag is already there, we should delete it (to mimic button switch)
-    delete_result = db["filters"].delete_one(
-        {
-            "user_id": user_id,
-            "tag_exclude": excluded_tag
-        }
+
+@db_function
+def store_visit(team_id, restaurant_id):
+    db["restaurants"].update_one(
+        {"_id": bson.ObjectId(restaurant_id), "team_id": team_id},
+        {"$set": {"last visited": datetime.datetime.utcnow()}}
     )
-    if delete_result.deleted_count == 0:
-        db["filters"].insert_one(
-            {
-                "user_id": user_id,
-                "tag_exclude": excluded_tag
-            }
+
+
+@db_function
+def store_feedback(team_id, restaurant_id, user_id, metric, value):
+    # one rating per user and metric, answering again (or clicking twice) replaces the previous value
+    rating_filter = {
+        "team_id": team_id,
+        "restaurant_id": bson.ObjectId(restaurant_id),
+        "user_id": user_id,
+        "metric": metric
+    }
+    rating_update = {"$set": {"value": value, "created_at": datetime.datetime.utcnow()}}
+    try:
+        previous_rating = db["ratings"].find_one_and_update(
+            rating_filter, rating_update, upsert=True, return_document=pymongo.ReturnDocument.BEFORE
+        )
+    except pymongo.errors.DuplicateKeyError:
+        # a concurrent click inserted the rating first, the retry updates it
+        previous_rating = db["ratings"].find_one_and_update(
+            rating_filter, rating_update, return_document=pymongo.ReturnDocument.BEFORE
         )
+    if previous_rating is None:
+        count_change, previous_value = 1, 0
+    else:
+        count_change, previous_value = 0, previous_rating["value"]
+    if count_change == 0 and previous_value == value:
+        return
+    # running aggregates, so mean and variance never have to be recomputed from the ratings,
+    # only the difference to the previous answer of the user is applied
+    db["restaurants"].update_one(
+        {"_id": bson.ObjectId(restaurant_id), "team_id": team_id},
+        {"$inc": {
+            f"feedback.{metric}.count": count_change,
+            f"feedback.{metric}.sum": value - previous_value,
+            f"feedback.{metric}.sum_sq": value ** 2 - previous_value ** 2
+        }}
+    )
 
 
-def store_price_limit(user_id, price_limit):
-    # store time limit value to user in db, replace if exists
-    db["filters"].update_one(
-        {
-            "user_id": user_id,
-            "price_limit": {"$exists": 1}
-        },
-        {
-            "$set": {"price_limit": int(price_limit)}
-        },
-        upsert=True
+@db_function
+def insert_pending_restaurant(team_id, token, restaurant):
+    db["pending_restaurants"].insert_one({
+        "_id": token,
+        "team_id": team_id,
+        "restaurant": restaurant,
+        "created_at": datetime.datetime.utcnow()
+    })
+
+
+@db_function
+def delete_pending_restaurant(team_id, token):
+    return db["pending_restaurants"].delete_one({"_id": token, "team_id": team_id}).deleted_count > 0
+
+
+@db_function
+def find_and_delete_pending_restaurant(team_id, token):
+    pending_restaurant = db["pending_restaurants"].find_one_and_delete({"_id": token, "team_id": team_id})
+    return pending_restaurant["restaurant"] if pending_restaurant is not None else None
+
+
+@db_function
+def create_session(team_id, started_user_id, user_ids):
+    created_at = datetime.datetime.utcnow()
+    deadline = created_at + datetime.timedelta(seconds=session_timeout)
+    session_id = db["sessions"].insert_one({
+        "team_id": team_id,
+        "started_user_id": started_user_id,
+        "created_at": created_at,
+        "deadline": deadline,
+        "users": [{"user_id": user_id, "finished": False, "excluded_tags": []} for user_id in user_ids],
+        "pending_count": len(user_ids),
+        # finalizing claims the session by switching the status, so only one worker sends the suggestions
+        "status": "collecting"
+    }).inserted_id
+    return session_id, deadline
+
+
+@db_function
+def get_session_deadlines():
+    return [
+        (session["deadline"], session["_id"])
+        for session in db["sessions"].find({"deadline": {"$exists": True}}, {"deadline": 1})
+    ]
+
+
+@db_function
+def claim_session(session_id):
+    # only the first claim of a session where nobody is pending anymore matches,
+    # so a session is finalized by exactly one worker, whatever else changed in it meanwhile
+    return db["sessions"].find_one_and_update(
+        {"_id": session_id, "status": "collecting", "pending_count": 0},
+        {"$set": {"status": "finalizing"}},
+        return_document=pymongo.ReturnDocument.AFTER
     )
 
 
-def store_time_limit(user_id, time_limit):
-    # store time limit value to user in db (replace if exists)
-    db["filters"].update_one(
-        {
-            "user_id": user_id,
-            "time_limit": {"$exists": 1}
-        },
+@db_function
+def claim_expired_session(session_id):
+    return db["sessions"].find_one_and_update(
+        {"_id": session_id, "status": "collecting", "deadline": {"$lte": datetime.datetime.utcnow()}},
+        {"$set": {"status": "finalizing"}},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+
+
+@db_function
+def set_user_finished_session(team_id, user_id):
+    # returns the session as it is after the update, it's finished when nobody is pending anymore
+    return db["sessions"].find_one_and_update(
+        {"team_id": team_id, "users": {"$elemMatch": {"user_id": user_id, "finished": False}}, "status": "collecting"},
         {
-            "$set": {"time_limit": int(time_limit)}
+            "$set": {"users.$.finished": True},
+            "$inc": {"pending_count": -1}
         },
-        upsert=True
+        return_document=pymongo.ReturnDocument.AFTER
     )
 
 
-def remove_restaurant(restaurant_id):
-    restaurant_id_to_remove = restaurant_id
-    restaurant_to_remove = db["restaurants"].find_one({"_id": bson.ObjectId(restaurant_id_to_remove)})
-    db["restaurants"].delete_one({"_id": bson.ObjectId(restaurant_id_to_remove)})
-    logger.debug(f"Restaurant removed from db: {restaurant_to_remove}")
-    return restaurant_to_remove
+@db_function
+def delete_session(session_id):
+    # the preferences stored in the session go with it
+    db["sessions"].delete_one({"_id": session_id})
 
 
-def set_user_finished_session(user_id):
-    db["sessions"].update_one(
-        {"users.user_id": user_id},
-        {"$set": {"users.$.finished": True}}
-    )
+@db_function
+def get_valid_session_for_user(team_id, user_id):
+    return db["sessions"].find_one({"team_id": team_id, "users.user_id": user_id, "status": "collecting"})
 
 
-def get_finished_session_for_user(user_id):
-    return db["sessions"].find_one({
-        "$nor": [{
-                "users": {
-                    "$elemMatch": {
-                        "user_id": {"$ne": user_id},
-                        "finished": {"$ne": True}
-                    }
-                }
-        }]
-    })
+@db_function
+def find_installation(team_id):
+    return db["installations"].find_one({"_id": team_id})
+
+
+@db_function
+def store_installation(installation):
+    # reinstalling replaces the tokens
+    db["installations"].replace_one({"_id": installation["_id"]}, installation, upsert=True)
+
 
+@db_function
+def delete_installation(team_id):
+    # restaurants and feedback are kept in case the app is installed again
+    db["installations"].delete_one({"_id": team_id})
 
-def delete_session_for_user(user_id):
-    # remove all sessions (it should be only one, but just in case)
-    db["sessions"].delete_many({"users.user_id": user_id})
 
+""" PENDING RESTAURANTS """
 
-def get_valid_session_for_user(user_id):
-    return db["sessions"].find_one({"users.user_id": user_id})
+
+async def store_pending_restaurant(team_id, token, restaurant):
+    await insert_pending_restaurant(team_id, token, restaurant)
+    pending_restaurant_cache[token] = (team_id, restaurant, time.monotonic() + pending_restaurant_ttl)
+    # the oldest entries are the first to expire, so evicting from the front handles both size and ttl
+    while len(pending_restaurant_cache) > pending_restaurant_cache_size or \
+            next(iter(pending_restaurant_cache.values()))[2] <= time.monotonic():
+        pending_restaurant_cache.popitem(last=False)
+
+
+async def pop_pending_restaurant(team_id, token):
+    cached_team_id, restaurant, expires_at = pending_restaurant_cache.pop(token, (None, None, 0))
+    if restaurant is not None and cached_team_id == team_id and expires_at > time.monotonic():
+        # the delete decides who gets it, in case the same button was clicked on another worker as well
+        return restaurant if await delete_pending_restaurant(team_id, token) else None
+    return await find_and_delete_pending_restaurant(team_id, token)
+
+
+""" BULK IMPORT & EXPORT """
+
+
+def get_import_format(file_name):
+    if file_name.endswith(".csv"):
+        return "csv"
+    elif file_name.endswith(".jsonl"):
+        return "jsonl"
+    return None
+
+
+def parse_restaurant_row(row):
+    try:
+        tags = row.get("tags") or []
+        restaurant = {
+            "name": str(row["name"]).strip(),
+            "address": str(row["address"]).strip(),
+            "initial duration": int(row["initial duration"]),
+            "initial rating": int(row["initial rating"]),
+            "initial price": int(row["initial price"]),
+            "tags": tags.split() if isinstance(tags, str) else [str(tag) for tag in tags]
+        }
+    except KeyError as e:
+        raise ValueError(f"missing {e}")
+    if restaurant["name"] == "":
+        raise ValueError("name is empty")
+    if not 1 <= restaurant["initial rating"] <= 5:
+        raise ValueError("rating should be between 1 and 5")
+    if row.get("latitude") not in (None, "") and row.get("longitude") not in (None, ""):
+        location = get_point(float(row["latitude"]), float(row["longitude"]))
+    else:
+        location = geocode(restaurant["address"])
+    if location is not None:
+        restaurant["location"] = location
+    return restaurant
+
+
+async def import_restaurants(team_id, lines, file_format):
+    # rows are parsed one by one and written in batches, so the file is never held in memory
+    counts = {"imported": 0, "invalid": 0}
+    import_errors = []
+    batch = []
+    columns = None
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        try:
+            # lines are decoded one by one, so a row in another encoding is skipped like any invalid row,
+            # and a bom from excel doesn't end up in the first column name
+            line = line.decode("utf-8-sig" if line_number == 1 else "utf-8")
+            if line.strip() == "":
+                continue
+            if file_format == "csv":
+                values = next(csv.reader([line]))
+                if columns is None:
+                    columns = [column.strip() for column in values]
+                    continue
+                row = dict(zip(columns, values))
+            else:
+                row = json_loads(line)
+            batch.append(parse_restaurant_row(row))
+        except (ValueError, TypeError, AttributeError) as e:
+            counts["invalid"] += 1
+            # the first few are enough to fix the file
+            if len(import_errors) < 10:
+                import_errors.append(f"line {line_number}: {e}")
+            continue
+
+        if len(batch) >= restaurant_import_batch_size:
+            await upsert_restaurants(team_id, batch)
+            counts["imported"] += len(batch)
+            batch = []
+
+    if len(batch) > 0:
+        await upsert_restaurants(team_id, batch)
+        counts["imported"] += len(batch)
+
+    if counts["imported"] > 0:
+        invalidate_restaurant_catalog(team_id)
+    return counts, import_errors
+
+
+async def read_url_lines(url, token):
+    async with http_session.get(
+        url,
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=aiohttp.ClientTimeout(total=None, sock_read=30)
+    ) as http_response:
+        http_response.raise_for_status()
+        async for line in http_response.content:
+            yield line
+
+
+async def read_file_lines(path):
+    with open(path, "rb") as file:
+        for line in file:
+            yield line
+
+
+async def import_restaurants_from_url(team_id, file_url, response_url):
+    try:
+        installation = await get_installation(team_id)
+        counts, import_errors = await import_restaurants(
+            team_id, read_url_lines(file_url, installation["bot_token"]), get_import_format(file_url)
+        )
+        response = get_response_for_import_restaurants_result(counts, import_errors)
+    except aiohttp.ClientError as e:
+        response = {
+            "response_type": "ephermal",
+            "text": f"Could not download the file: {e}"
+        }
+    except pymongo.errors.PyMongoError as e:
+        errors.labels("import restaurants").inc()
+        logger.error(f"ERROR: {e}")
+        # the batches written before the error are kept, importing the file again updates them
+        response = {
+            "response_type": "ephermal",
+            "text": "Could not save the restaurants, some of them might be missing. Please try again."
+        }
+    await post_to_response_url(response_url, response)
+
+
+def get_restaurant_export_row(restaurant):
+    row = {field: restaurant.get(field) for field in restaurant_import_fields}
+    if restaurant.get("location") is not None:
+        row["latitude"], row["longitude"] = get_restaurant_coordinates(restaurant)
+    return row
+
+
+def export_restaurants(team_id, output, file_format):
+    restaurants = db["restaurants"].find({"team_id": team_id}, restaurant_import_fields + ["location"]).batch_size(
+        restaurant_import_batch_size
+    )
+    fields = restaurant_import_fields + restaurant_import_location_fields
+    if file_format == "csv":
+        writer = csv.writer(output)
+        writer.writerow(fields)
+        for restaurant in restaurants:
+            row = get_restaurant_export_row(restaurant)
+            writer.writerow([
+                " ".join(row[field] or []) if field == "tags" else row.get(field, "")
+                for field in fields
+            ])
+    else:
+        for restaurant in restaurants:
+            output.write(json.dumps(get_restaurant_export_row(restaurant)) + "\n")
 
 
 """ HELPER FUNCTIONS """
 
 
+def create_background_task(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(on_background_task_done)
+    return task
+
+
+def on_background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        errors.labels("background task").inc()
+        logger.error(f"ERROR: {task.exception()}")
+
+
+def parse_feedback_value(metric, value):
+    if metric not in feedback_questions or not value.isdigit():
+        return None
+    if int(value) not in feedback_questions[metric]["options"]:
+        return None
+    return int(value)
+
+
 def get_prettyfied_dict(parameters):
-    return [f"{k}: {', '.join(v)}" if isinstance(v, list) else f"{k}: {v}" for k, v in parameters]
+    return [
+        f"{k}: {', '.join(v)}" if isinstance(v, list) else
+        f"{k}: {v['coordinates'][1]}, {v['coordinates'][0]}" if k == "location" else
+        f"{k}: {v}"
+        for k, v in parameters
+    ]
 
 
-def send_suggested_restaurants_to_users(finished_session):
+async def send_suggested_restaurants_to_users(finished_session):
+    team_id = finished_session["team_id"]
     user_ids = [user["user_id"] for user in finished_session["users"]]
-    suggested_restaurants = get_suggested_restaurants(user_ids)
-    for user_id in user_ids:
-        asyncio.create_task(
-            start_dm(
-                user_id,
-                get_blocks_for_suggested_restaurants(suggested_restaurants)
-            )
+    # users who timed out are opted out, only the ones who finished answering count
+    finished_users = [user for user in finished_session["users"] if user["finished"]]
+    timed_out_user_ids = [user["user_id"] for user in finished_session["users"] if not user["finished"]]
+    if len(finished_users) == 0:
+        # without any inputs there is nothing to suggest and nobody to ask for feedback
+        await send_dms(team_id, user_ids, get_blocks_for_timed_out_session())
+        return
+    suggested_restaurants = await get_suggested_restaurants(team_id, finished_users)
+    # everybody gets the same message, so it's rendered once and shared between the DMs
+    await send_dms(team_id, user_ids, get_blocks_for_suggested_restaurants(suggested_restaurants, timed_out_user_ids))
+
+    if len(suggested_restaurants) > 0:
+        await send_dms(
+            team_id,
+            user_ids,
+            get_blocks_for_asking_feedback(suggested_restaurants),
+            post_at=int(time.time()) + feedback_delay
         )
+
+
+""" COMMAND LINE """
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage Lunchbot's restaurants.")
+    parser.add_argument("--team-id", default=slack_team_id, help="the workspace of the restaurants")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="import restaurants from a .csv or .jsonl file")
+    import_parser.add_argument("file")
+    import_parser.add_argument("--format", choices=["csv", "jsonl"])
+    export_parser = subparsers.add_parser("export", help="export restaurants to the standard output")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"], default="jsonl")
+    arguments = parser.parse_args()
+    if arguments.team_id is None:
+        parser.error("the workspace has to be given with --team-id or SLACK_TEAM_ID")
+
+    if arguments.command == "import":
+        load_geocoding_table()
+        file_format = arguments.format or get_import_format(arguments.file)
+        if file_format is None:
+            parser.error("can't tell the format from the file name, please use --format")
+        counts, import_errors = asyncio.run(
+            import_restaurants(arguments.team_id, read_file_lines(arguments.file), file_format)
+        )
+        for import_error in import_errors:
+            print(import_error, file=sys.stderr)
+        print(f"Imported {counts['imported']} restaurant(s), skipped {counts['invalid']} invalid row(s).")
+    else:
+        export_restaurants(arguments.team_id, sys.stdout, arguments.format)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import mongomock
+import pymongo
+import pytest
+
+# the app connects to mongodb when it's imported, so mongomock has to be in place before that
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost/lunchbot_test")
+os.environ.setdefault("SLACK_SIGNING_SECRET", "test-signing-secret")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+pymongo.MongoClient = mongomock.MongoClient
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as lunchbot  # noqa: E402
+
+
+@pytest.fixture
+def app_module():
+    for collection in lunchbot.db.list_collection_names():
+        lunchbot.db.drop_collection(collection)
+    lunchbot.invalidate_restaurant_catalog()
+    # the locks belong to the event loop of the test that created them
+    lunchbot.restaurant_catalog_locks.clear()
+    return lunchbot
@@ -0,0 +1,43 @@
+import time
+
+from aiohttp import web
+
+
+class FakeSlack:
+    # a local Slack Web API, rate limiting the first calls when asked to
+    def __init__(self, rate_limited_calls=0, retry_after=0):
+        self.rate_limited_calls = rate_limited_calls
+        self.retry_after = retry_after
+        self.calls = []
+        self.url = None
+        self.runner = None
+
+    async def __aenter__(self):
+        application = web.Application()
+        application.router.add_post("/api/{method}", self.handle_api)
+        self.runner = web.AppRunner(application)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/api/"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.runner.cleanup()
+
+    def get_calls(self, method):
+        return [(body, called_at) for called_method, body, called_at in self.calls if called_method == method]
+
+    async def handle_api(self, http_request):
+        method = http_request.match_info["method"]
+        body = await http_request.json() if http_request.content_type == "application/json" else {}
+        self.calls.append((method, body, time.monotonic()))
+
+        if self.rate_limited_calls > 0:
+            self.rate_limited_calls -= 1
+            return web.json_response(
+                {"ok": False, "error": "ratelimited"}, status=429, headers={"Retry-After": str(self.retry_after)}
+            )
+        if method == "im.open":
+            return web.json_response({"ok": True, "channel": {"id": f"D{body['user']}"}})
+        return web.json_response({"ok": True})
@@ -0,0 +1,67 @@
+import asyncio
+import threading
+import time
+
+import pymongo
+import pytest
+
+
+def test_db_functions_run_on_the_db_executor(app_module):
+    @app_module.db_function
+    def get_thread():
+        return threading.current_thread()
+
+    async def run():
+        return threading.current_thread(), await get_thread()
+
+    loop_thread, db_thread = asyncio.run(run())
+    assert db_thread is not loop_thread
+    assert db_thread.name.startswith("lunchbot-db")
+
+
+def test_blocking_db_call_does_not_stall_the_event_loop(app_module):
+    @app_module.db_function
+    def slow_query():
+        time.sleep(0.3)
+        return "done"
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        result = await slow_query()
+        ticker.cancel()
+        return result, ticks
+
+    result, ticks = asyncio.run(run())
+    assert result == "done"
+    # the ticker kept running while the query was blocking its thread
+    assert ticks >= 10
+
+
+def test_db_function_exceptions_propagate(app_module):
+    async def run():
+        await app_module.insert_pending_restaurant("T1", "token", {"name": "Suppé"})
+        await app_module.insert_pending_restaurant("T1", "token", {"name": "Suppé"})
+
+    with pytest.raises(pymongo.errors.DuplicateKeyError):
+        asyncio.run(run())
+
+
+def test_session_round_trip(app_module):
+    async def run():
+        session_id, _ = await app_module.create_session("T1", "U0", ["U1", "U2"])
+        await app_module.store_time_limit("T1", "U1", "45")
+        return session_id, await app_module.get_valid_session_for_user("T1", "U1")
+
+    session_id, session = asyncio.run(run())
+    assert session["_id"] == session_id
+    assert session["users"][0]["time_limit"] == 45
+    # sessions are scoped to their workspace
+    assert asyncio.run(app_module.get_valid_session_for_user("T2", "U1")) is None
@@ -0,0 +1,32 @@
+import asyncio
+
+
+def insert_restaurant(app_module):
+    return str(app_module.db["restaurants"].insert_one({"team_id": "T1", "name": "Bistro"}).inserted_id)
+
+
+def get_aggregate(app_module, restaurant_id, metric):
+    restaurant = app_module.db["restaurants"].find_one({"_id": app_module.bson.ObjectId(restaurant_id)})
+    return restaurant["feedback"][metric]
+
+
+def test_changed_answer_replaces_the_previous_one(app_module):
+    restaurant_id = insert_restaurant(app_module)
+
+    async def run():
+        await app_module.store_feedback("T1", restaurant_id, "U1", "rating", 2)
+        await app_module.store_feedback("T1", restaurant_id, "U1", "rating", 5)
+        await app_module.store_feedback("T1", restaurant_id, "U1", "rating", 5)
+        await app_module.store_feedback("T1", restaurant_id, "U2", "rating", 3)
+
+    asyncio.run(run())
+    assert get_aggregate(app_module, restaurant_id, "rating") == {"count": 2, "sum": 8, "sum_sq": 34}
+    assert app_module.db["ratings"].count_documents({}) == 2
+
+
+def test_only_offered_feedback_is_accepted(app_module):
+    assert app_module.parse_feedback_value("price", "1500") == 1500
+    assert app_module.parse_feedback_value("rating", "6") is None
+    assert app_module.parse_feedback_value("rating", "-1") is None
+    assert app_module.parse_feedback_value("rating", "4.5") is None
+    assert app_module.parse_feedback_value("$where", "1") is None
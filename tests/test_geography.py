@@ -0,0 +1,21 @@
+import logging
+
+
+def test_geocoding_table_is_loaded_up_front(app_module, monkeypatch, tmp_path):
+    table_path = tmp_path / "geocoding.csv"
+    table_path.write_text("address,latitude,longitude\n\"Fő utca 1, Budapest\",47.5,19.04\n", encoding="utf-8")
+    monkeypatch.setattr(app_module, "geocoding_table_path", str(table_path))
+    monkeypatch.setattr(app_module, "geocoding_table", {})
+
+    app_module.load_geocoding_table()
+    assert app_module.geocode("fő utca 1 budapest") == app_module.get_point(47.5, 19.04)
+
+
+def test_missing_geocoding_table_is_logged(app_module, monkeypatch, tmp_path, caplog):
+    monkeypatch.setattr(app_module, "geocoding_table_path", str(tmp_path / "missing.csv"))
+    monkeypatch.setattr(app_module, "geocoding_table", {})
+
+    with caplog.at_level(logging.ERROR, logger="lunchbot"):
+        app_module.load_geocoding_table()
+    assert "missing.csv not found" in caplog.text
+    assert app_module.geocode("Fő utca 1, Budapest") is None
@@ -0,0 +1,114 @@
+import asyncio
+import io
+
+import pytest
+
+RESTAURANTS = [
+    {
+        "name": "Bistro", "address": "Fő utca 1, Budapest", "initial duration": 30, "initial rating": 4,
+        "initial price": 1500, "tags": ["soup", "vegan"], "latitude": 47.5, "longitude": 19.04
+    },
+    {
+        "name": "Pizzeria", "address": "Király utca 2, Budapest", "initial duration": 45, "initial rating": 3,
+        "initial price": 2000, "tags": ["pizza"]
+    }
+]
+
+
+async def get_lines(data):
+    for line in io.BytesIO(data):
+        yield line
+
+
+def import_data(app_module, data, file_format):
+    return asyncio.run(app_module.import_restaurants("T1", get_lines(data), file_format))
+
+
+def export_data(app_module, file_format):
+    output = io.StringIO()
+    app_module.export_restaurants("T1", output, file_format)
+    return output.getvalue().encode("utf-8")
+
+
+def get_stored_restaurants(app_module):
+    return sorted(
+        app_module.db["restaurants"].find({"team_id": "T1"}, {"_id": 0, "team_id": 0}),
+        key=lambda restaurant: restaurant["name"]
+    )
+
+
+def get_tag_counts(app_module):
+    return {tag["tag"]: tag["count"] for tag in app_module.db["tags"].find({"team_id": "T1"})}
+
+
+@pytest.mark.parametrize("file_format", ["csv", "jsonl"])
+def test_exported_restaurants_import_unchanged(app_module, file_format):
+    data = "".join(app_module.json.dumps(restaurant) + "\n" for restaurant in RESTAURANTS).encode("utf-8")
+    assert import_data(app_module, data, "jsonl") == ({"imported": 2, "invalid": 0}, [])
+    restaurants = get_stored_restaurants(app_module)
+
+    exported = export_data(app_module, file_format)
+    app_module.db["restaurants"].delete_many({})
+    app_module.db["tags"].delete_many({})
+    assert import_data(app_module, exported, file_format) == ({"imported": 2, "invalid": 0}, [])
+    assert get_stored_restaurants(app_module) == restaurants
+    assert restaurants[0]["location"] == app_module.get_point(47.5, 19.04)
+    assert get_tag_counts(app_module) == {"soup": 1, "vegan": 1, "pizza": 1}
+
+
+def test_csv_from_excel_with_bom_and_another_encoding(app_module):
+    data = (
+        "\ufeffname,address,initial duration,initial rating,initial price,tags\r\n"
+        "Bistro,Main street 1,30,4,1500,soup\r\n"
+    ).encode("utf-8") + "Kávézó,Fő utca 2,20,5,900,coffee\r\n".encode("cp1250")
+
+    counts, import_errors = import_data(app_module, data, "csv")
+    assert counts == {"imported": 1, "invalid": 1}
+    assert import_errors[0].startswith("line 3: 'utf-8' codec can't decode")
+    assert [restaurant["name"] for restaurant in get_stored_restaurants(app_module)] == ["Bistro"]
+
+
+def test_reimport_updates_the_tag_counts(app_module):
+    def get_row(tags):
+        return f"Bistro,Main street 1,30,4,1500,{tags}\n"
+
+    header = "name,address,initial duration,initial rating,initial price,tags\n"
+    import_data(app_module, (header + get_row("soup vegan")).encode("utf-8"), "csv")
+    import_data(app_module, (header + get_row("soup pizza") + get_row("soup thai")).encode("utf-8"), "csv")
+    assert get_tag_counts(app_module) == {"soup": 1, "thai": 1}
+
+
+def test_invalid_rows_are_reported(app_module):
+    data = b'{"name": "Bistro"}\n\n{"name": "Pizzeria", "address": "x", "initial duration": 1, ' \
+        b'"initial rating": 9, "initial price": 1, "tags": []}\nnot json\n'
+
+    counts, import_errors = import_data(app_module, data, "jsonl")
+    assert counts == {"imported": 0, "invalid": 3}
+    assert import_errors[0] == "line 1: missing 'address'"
+    assert import_errors[1] == "line 3: rating should be between 1 and 5"
+
+
+def test_db_error_during_an_import_is_reported(app_module, monkeypatch):
+    responses = []
+
+    async def get_installation(team_id):
+        return {"_id": team_id, "bot_token": "xoxb-1"}
+
+    async def read_url_lines(url, token):
+        yield b"name,address,initial duration,initial rating,initial price,tags\n"
+        yield b"Bistro,Main street 1,30,4,1500,soup\n"
+
+    async def upsert_restaurants(team_id, restaurants):
+        raise app_module.pymongo.errors.AutoReconnect("connection lost")
+
+    async def post_to_response_url(response_url, response):
+        responses.append((response_url, response))
+
+    monkeypatch.setattr(app_module, "get_installation", get_installation)
+    monkeypatch.setattr(app_module, "read_url_lines", read_url_lines)
+    monkeypatch.setattr(app_module, "upsert_restaurants", upsert_restaurants)
+    monkeypatch.setattr(app_module, "post_to_response_url", post_to_response_url)
+
+    asyncio.run(app_module.import_restaurants_from_url("T1", "https://files.slack.com/restaurants.csv", "url"))
+    assert responses[0][0] == "url"
+    assert responses[0][1]["text"].startswith("Could not save the restaurants")
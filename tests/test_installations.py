@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+
+def test_missing_installation_is_not_cached(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "installation_cache", {})
+
+    async def run():
+        missing = await app_module.get_installation("T1")
+        app_module.db["installations"].insert_one({"_id": "T1", "bot_token": "xoxb-1"})
+        return missing, await app_module.get_installation("T1")
+
+    missing, installed = asyncio.run(run())
+    assert missing is None
+    assert installed["bot_token"] == "xoxb-1"
+
+
+def test_legacy_documents_without_team_fail_the_startup(app_module):
+    app_module.db["restaurants"].insert_one({"name": "Bistro"})
+
+    with pytest.raises(ValueError, match="SLACK_TEAM_ID"):
+        asyncio.run(app_module.migrate_legacy_documents(None))
+
+
+def test_legacy_documents_are_assigned_to_the_team(app_module):
+    app_module.db["restaurants"].insert_one({"name": "Bistro"})
+
+    asyncio.run(app_module.migrate_legacy_documents("T1"))
+    assert app_module.db["restaurants"].find_one({"name": "Bistro"})["team_id"] == "T1"
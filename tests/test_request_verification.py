@@ -0,0 +1,64 @@
+import asyncio
+import collections
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+
+BODY = json.dumps({"type": "url_verification", "challenge": "challenge"})
+
+
+def get_headers(app_module, body, timestamp=None, signature=None):
+    timestamp = str(int(time.time())) if timestamp is None else str(timestamp)
+    if signature is None:
+        signature = "v0=" + hmac.new(
+            app_module.slack_signing_secret, f"v0:{timestamp}:{body}".encode(), hashlib.sha256
+        ).hexdigest()
+    return {"X-Slack-Request-Timestamp": timestamp, "X-Slack-Signature": signature}
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "slack_request_signatures", collections.OrderedDict())
+    return app_module.app.test_client()
+
+
+def post_events(client, headers, body=BODY):
+    async def run():
+        response = await client.post("/events", data=body, headers=headers)
+        return response.status_code
+    return asyncio.run(run())
+
+
+def test_valid_signature_is_accepted(app_module, client):
+    assert post_events(client, get_headers(app_module, BODY)) == 200
+
+
+def test_bad_signature_is_rejected(app_module, client):
+    assert post_events(client, get_headers(app_module, BODY, signature="v0=" + "0" * 64)) == 401
+    # the signature covers the body
+    assert post_events(client, get_headers(app_module, BODY), body=BODY.replace("challenge", "forged")) == 401
+
+
+def test_old_timestamp_is_rejected(app_module, client):
+    timestamp = int(time.time()) - app_module.slack_request_max_age - 1
+    assert post_events(client, get_headers(app_module, BODY, timestamp=timestamp)) == 401
+
+
+def test_replayed_signature_is_rejected(app_module, client):
+    headers = get_headers(app_module, BODY)
+    assert post_events(client, headers) == 200
+    assert post_events(client, headers) == 401
+
+
+@pytest.mark.parametrize("path, status_code", [
+    ("/metrics", 200), ("/install", 302), ("/oauth?error=access_denied", 200)
+])
+def test_routes_not_called_by_slack_are_exempt(client, path, status_code):
+    async def run():
+        response = await client.get(path)
+        return response.status_code
+
+    assert asyncio.run(run()) == status_code
@@ -0,0 +1,61 @@
+import asyncio
+
+
+def test_removing_a_restaurant_twice_reports_it_not_found(app_module):
+    restaurant_id = str(app_module.db["restaurants"].insert_one({
+        "team_id": "T1", "name": "Bistro", "tags": []
+    }).inserted_id)
+
+    async def run():
+        removed = await app_module.remove_restaurant("T1", restaurant_id)
+        removed_again = await app_module.remove_restaurant("T1", restaurant_id)
+        app_module.invalidate_restaurant_catalog("T1")
+        catalog = await app_module.get_restaurant_catalog("T1")
+        return removed, removed_again, app_module.get_response_for_remove_restaurant(removed_again, catalog, "first")
+
+    removed, removed_again, response = asyncio.run(run())
+    assert removed["name"] == "Bistro"
+    assert removed_again is None
+    assert "not found" in response["blocks"][-1]["text"]["text"]
+
+
+def test_catalog_rebuilt_before_a_write_is_not_kept(app_module, monkeypatch):
+    get_restaurants = app_module.get_restaurants
+
+    async def get_restaurants_during_a_write(team_id):
+        restaurants = await get_restaurants(team_id)
+        # the write lands after the rebuild read the collection
+        app_module.db["restaurants"].insert_one({
+            "team_id": team_id, "name": "Bistro", "address": "Fő utca 1", "tags": [],
+            "initial duration": 30, "initial rating": 4, "initial price": 1500
+        })
+        app_module.invalidate_restaurant_catalog(team_id)
+        return restaurants
+
+    async def run():
+        monkeypatch.setattr(app_module, "get_restaurants", get_restaurants_during_a_write)
+        outdated_catalog = await app_module.get_restaurant_catalog("T1")
+        monkeypatch.setattr(app_module, "get_restaurants", get_restaurants)
+        return outdated_catalog, await app_module.get_restaurant_catalog("T1")
+
+    outdated_catalog, catalog = asyncio.run(run())
+    assert len(outdated_catalog["restaurants"]) == 0
+    assert [restaurant["name"] for restaurant in catalog["restaurants"]] == ["Bistro"]
+
+
+def test_concurrent_catalog_misses_share_one_rebuild(app_module, monkeypatch):
+    get_restaurants = app_module.get_restaurants
+    calls = []
+
+    async def counted_get_restaurants(team_id):
+        calls.append(team_id)
+        return await get_restaurants(team_id)
+
+    monkeypatch.setattr(app_module, "get_restaurants", counted_get_restaurants)
+
+    async def run():
+        return await asyncio.gather(*[app_module.get_restaurant_catalog("T1") for _ in range(10)])
+
+    catalogs = asyncio.run(run())
+    assert calls == ["T1"]
+    assert all(catalog is catalogs[0] for catalog in catalogs)
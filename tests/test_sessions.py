@@ -0,0 +1,110 @@
+import asyncio
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+# the multi-process test needs a store shared between the processes, mongomock lives in one process
+stress_mongodb_uri = os.environ.get("LUNCHBOT_STRESS_MONGODB_URI")
+stress_sessions = 50
+stress_users = 4
+
+
+def test_session_without_answers_times_out_without_suggestions(app_module, monkeypatch):
+    sent_dms = []
+
+    async def send_dms(team_id, user_ids, blocks, post_at=None):
+        sent_dms.append((user_ids, blocks, post_at))
+
+    async def get_suggested_restaurants(team_id, users):
+        raise AssertionError("nothing should be suggested without inputs")
+
+    monkeypatch.setattr(app_module, "send_dms", send_dms)
+    monkeypatch.setattr(app_module, "get_suggested_restaurants", get_suggested_restaurants)
+    session = {
+        "team_id": "T1",
+        "users": [{"user_id": "U1", "finished": False}, {"user_id": "U2", "finished": False}]
+    }
+
+    asyncio.run(app_module.send_suggested_restaurants_to_users(session))
+    assert sent_dms == [(["U1", "U2"], app_module.get_blocks_for_timed_out_session(), None)]
+
+
+def test_exclude_click_after_finishing_does_not_break_the_claim(app_module):
+    async def run():
+        session_id, _ = await app_module.create_session("T1", "U1", ["U1", "U2"])
+        await app_module.set_user_finished_session("T1", "U1")
+        session = await app_module.set_user_finished_session("T1", "U2")
+        # a late click on a tag button changes the session between finishing and claiming
+        await app_module.store_excluded_tag("T1", "U1", "pizza")
+        return await app_module.claim_session(session["_id"]), await app_module.claim_session(session_id)
+
+    first_claim, second_claim = asyncio.run(run())
+    assert first_claim["status"] == "finalizing"
+    assert second_claim is None
+
+
+def test_unfinished_session_cannot_be_claimed(app_module):
+    async def run():
+        session_id, _ = await app_module.create_session("T1", "U1", ["U1", "U2"])
+        await app_module.set_user_finished_session("T1", "U1")
+        return await app_module.claim_session(session_id)
+
+    assert asyncio.run(run()) is None
+
+
+def finish_sessions(user_index, barrier, claimed_session_ids):
+    # every process answers for one user of each session, the last one to finish has to claim it
+    os.environ["MONGODB_URI"] = stress_mongodb_uri
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as lunchbot
+
+    async def run():
+        claimed = []
+        for session_index in range(stress_sessions):
+            team_id, user_id = f"T{session_index}", f"U{user_index}"
+            session = await lunchbot.set_user_finished_session(team_id, user_id)
+            await lunchbot.store_excluded_tag(team_id, user_id, "pizza")
+            if session is not None and session["pending_count"] == 0:
+                if await lunchbot.claim_session(session["_id"]) is not None:
+                    claimed.append(str(session["_id"]))
+        return claimed
+
+    barrier.wait()
+    claimed_session_ids.put(asyncio.run(run()))
+
+
+@pytest.mark.skipif(stress_mongodb_uri is None, reason="LUNCHBOT_STRESS_MONGODB_URI is not set")
+def test_each_session_is_finalized_exactly_once_across_processes():
+    from pymongo.mongo_client import MongoClient
+    from urllib.parse import urlparse
+
+    db = MongoClient(stress_mongodb_uri)[urlparse(stress_mongodb_uri).path[1:]]
+    db["sessions"].drop()
+    session_ids = sorted(str(db["sessions"].insert_one({
+        "team_id": f"T{session_index}",
+        "users": [
+            {"user_id": f"U{user_index}", "finished": False, "excluded_tags": []}
+            for user_index in range(stress_users)
+        ],
+        "pending_count": stress_users,
+        "status": "collecting"
+    }).inserted_id) for session_index in range(stress_sessions))
+
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(stress_users)
+    claimed_session_ids = context.Queue()
+    processes = [
+        context.Process(target=finish_sessions, args=(user_index, barrier, claimed_session_ids))
+        for user_index in range(stress_users)
+    ]
+    for process in processes:
+        process.start()
+    claimed = sum((claimed_session_ids.get(timeout=60) for _ in processes), [])
+    for process in processes:
+        process.join()
+
+    assert sorted(claimed) == session_ids
+    assert db["sessions"].count_documents({"status": "finalizing"}) == stress_sessions
+    db["sessions"].drop()
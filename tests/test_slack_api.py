@@ -0,0 +1,120 @@
+import asyncio
+import collections
+import time
+
+import pytest
+from slack.errors import SlackApiError
+
+from fake_slack import FakeSlack
+
+
+@pytest.fixture
+def slack(app_module, monkeypatch):
+    # a fresh client pool and fresh buckets, so every test talks to its own fake server
+    monkeypatch.setattr(app_module, "slack_clients", collections.OrderedDict())
+    monkeypatch.setattr(app_module, "installation_cache", {})
+    monkeypatch.setattr(app_module, "slack_rate_limit_buckets", collections.OrderedDict())
+    monkeypatch.setattr(app_module, "dm_channels", {})
+    # restored after the test, the fake server's url is set once it's listening
+    monkeypatch.setattr(app_module, "slack_api_url", app_module.slack_api_url)
+    app_module.db["installations"].insert_one({"_id": "T1", "bot_token": "xoxb-test"})
+    return app_module
+
+
+def connect(app_module, fake_slack):
+    app_module.slack_api_url = fake_slack.url
+
+
+def test_rate_limited_call_is_retried_after_retry_after(slack):
+    async def run():
+        async with FakeSlack(rate_limited_calls=1, retry_after=1) as fake_slack:
+            connect(slack, fake_slack)
+            started_at = time.monotonic()
+            response = await slack.slack_api("T1", "chat.postMessage", is_bot=True, json={"channel": "D1"})
+            return response, time.monotonic() - started_at, fake_slack.get_calls("chat.postMessage")
+
+    rate_limited_before = slack.slack_api_rate_limited.labels("chat.postMessage")._value.get()
+    response, elapsed, calls = asyncio.run(run())
+    assert response["ok"]
+    assert len(calls) == 2
+    assert calls[1][1] - calls[0][1] >= 1
+    assert elapsed >= 1
+    assert slack.slack_api_rate_limited.labels("chat.postMessage")._value.get() == rate_limited_before + 1
+
+
+def test_rate_limited_call_gives_up_after_the_retries(slack, monkeypatch):
+    monkeypatch.setattr(slack, "slack_api_retries", 2)
+    fake_slack = FakeSlack(rate_limited_calls=10)
+
+    async def run():
+        async with fake_slack:
+            connect(slack, fake_slack)
+            await slack.slack_api("T1", "users.info", params={"user": "U1"})
+
+    with pytest.raises(SlackApiError) as e:
+        asyncio.run(run())
+    assert e.value.response.status_code == 429
+    assert len(fake_slack.get_calls("users.info")) == 3
+
+
+def test_messages_only_wait_for_their_own_channel(slack, monkeypatch):
+    # a message every 0.1 s in each channel, no burst
+    monkeypatch.setitem(slack.slack_rate_limit_tiers, "special", (600, 1))
+
+    async def post(channels):
+        started_at = time.monotonic()
+        await asyncio.gather(*(
+            slack.slack_api("T1", "chat.postMessage", is_bot=True, json={"channel": channel}) for channel in channels
+        ))
+        return time.monotonic() - started_at
+
+    async def run():
+        async with FakeSlack() as fake_slack:
+            connect(slack, fake_slack)
+            return await post([f"D{i}" for i in range(10)]), await post(["D100"] * 10)
+
+    different_channels, same_channel = asyncio.run(run())
+    assert same_channel >= 0.9
+    assert different_channels < 0.5
+
+
+def test_refilled_buckets_are_dropped(slack, monkeypatch):
+    monkeypatch.setitem(slack.slack_rate_limit_tiers, "special", (600, 1))
+
+    async def run():
+        for i in range(10):
+            await slack.wait_for_slack_rate_limit("T1", "chat.postMessage", f"D{i}")
+        buckets_before = len(slack.slack_rate_limit_buckets)
+        # a bucket refills in 0.1 s
+        await asyncio.sleep(0.15)
+        await slack.wait_for_slack_rate_limit("T1", "chat.postMessage", "D10")
+        return buckets_before, list(slack.slack_rate_limit_buckets)
+
+    buckets_before, buckets_after = asyncio.run(run())
+    assert buckets_before == 10
+    assert buckets_after == [("T1", "special", "D10")]
+
+
+def test_dm_queue_is_bounded_and_drained_by_the_workers(slack, monkeypatch):
+    async def run():
+        async with FakeSlack() as fake_slack:
+            connect(slack, fake_slack)
+            monkeypatch.setattr(slack, "dm_queue", asyncio.Queue(maxsize=2))
+            await slack.enqueue_dm("T1", "U1", [])
+            await slack.enqueue_dm("T1", "U2", [])
+            # the queue is full, so producers wait instead of piling up
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(slack.enqueue_dm("T1", "U1", []), 0.2)
+
+            worker = asyncio.create_task(slack.process_dm_queue())
+            await slack.enqueue_dm("T1", "U1", [])
+            await asyncio.wait_for(slack.dm_queue.join(), 5)
+            worker.cancel()
+            return fake_slack
+
+    sent_before = slack.dm_deliveries.labels("sent")._value.get()
+    fake_slack = asyncio.run(run())
+    assert len(fake_slack.get_calls("chat.postMessage")) == 3
+    # dm channels are cached, so each user is opened once
+    assert sorted(body["user"] for body, _ in fake_slack.get_calls("im.open")) == ["U1", "U2"]
+    assert slack.dm_deliveries.labels("sent")._value.get() == sent_before + 3
@@ -0,0 +1,68 @@
+import datetime
+import random
+
+import pytest
+
+TAGS = ["pizza", "soup", "burger", "sushi", "vegan", "thai"]
+OFFICES = {
+    "north": {"location": [47.52, 19.05], "users": ["U0", "U1", "U2"]},
+    "south": {"location": [47.48, 19.06], "users": ["U3", "U4"]}
+}
+
+
+def generate_restaurant(app_module, i, now):
+    restaurant = {
+        "_id": app_module.bson.ObjectId(),
+        "name": f"Restaurant {i}",
+        "address": f"Street {i}",
+        "initial duration": random.uniform(10, 60),
+        "initial rating": random.uniform(1, 5),
+        "initial price": random.uniform(500, 3000),
+        "tags": random.sample(TAGS, random.randint(0, 2))
+    }
+    # restaurants without a location are assumed to be next door
+    if random.random() < 0.8:
+        restaurant["location"] = app_module.get_point(random.uniform(47.47, 47.53), random.uniform(19.02, 19.09))
+    if random.random() < 0.3:
+        restaurant["last visited"] = now - datetime.timedelta(days=random.uniform(0, 20))
+    if random.random() < 0.3:
+        values = [random.choice(app_module.feedback_questions["rating"]["options"]) for _ in range(3)]
+        restaurant["feedback"] = {
+            "rating": {"count": len(values), "sum": sum(values), "sum_sq": sum(value ** 2 for value in values)}
+        }
+    return restaurant
+
+
+def generate_user(user_id):
+    user = {"user_id": user_id, "excluded_tags": random.sample(TAGS, random.randint(0, 1))}
+    if random.random() < 0.8:
+        user["time_limit"] = random.choice([30, 45, 60, 90])
+    if random.random() < 0.8:
+        user["price_limit"] = random.choice([1000, 1500, 2000, 3000])
+    return user
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_column_and_bitset_matchers_agree(app_module, monkeypatch, seed):
+    monkeypatch.setattr(app_module, "offices", OFFICES)
+    monkeypatch.setattr(app_module, "user_offices", {
+        user_id: office for office, details in OFFICES.items() for user_id in details["users"]
+    })
+    monkeypatch.setattr(app_module, "default_office", "north")
+    random.seed(seed)
+    now = datetime.datetime.utcnow()
+    restaurants = sorted(
+        [generate_restaurant(app_module, i, now) for i in range(200)], key=lambda restaurant: restaurant["_id"]
+    )
+    catalog = app_module.build_restaurant_catalog(restaurants, [])
+    # users U5 and above fall back to the default office
+    users = [generate_user(f"U{i}") for i in random.sample(range(7), random.randint(1, 5))]
+    filters = app_module.get_group_filters(users)
+
+    matched = app_module.match_restaurants(catalog, filters)
+    ranked = app_module.rank_restaurants(matched, filters, len(restaurants))
+    column_ranked = app_module.match_and_rank_restaurant_columns(catalog, filters, len(restaurants))
+    assert [restaurant["name"] for restaurant in column_ranked] == [restaurant["name"] for restaurant in ranked]
+
+    limited = app_module.match_and_rank_restaurant_columns(catalog, filters, app_module.suggestion_limit)
+    assert limited == ranked[:app_module.suggestion_limit]
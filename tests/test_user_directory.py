@@ -0,0 +1,18 @@
+import asyncio
+
+
+def test_directory_is_loaded_on_first_use(app_module, monkeypatch):
+    calls = []
+
+    async def slack_api(team_id, method, is_bot=False, **kwargs):
+        calls.append(method)
+        return {"ok": True, "members": [{"id": "U1"}], "response_metadata": {"next_cursor": ""}}
+
+    monkeypatch.setattr(app_module, "slack_api", slack_api)
+    monkeypatch.setattr(app_module, "user_directories", {})
+    # right after boot the monotonic clock can be smaller than the ttl
+    monkeypatch.setattr(app_module.time, "monotonic", lambda: 10.0)
+
+    assert asyncio.run(app_module.is_valid_user("T1", "U1"))
+    assert asyncio.run(app_module.is_valid_user("T1", "U1"))
+    assert calls == ["users.list"]